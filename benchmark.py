@@ -0,0 +1,160 @@
+"""Benchmark de carga reprodutível do canal de denúncias.
+
+Cria um banco SQLite temporário com N denúncias e M mensagens, dispara as rotas principais
+pelo test client do Flask e mostra vazão, p50/p95 e consultas SQL por requisição.
+
+    python benchmark.py --denuncias 5000 --mensagens 50000 --requisicoes 200
+    python benchmark.py --limite-p95 admin=150 --limite-p95 consulta=80   # sai com 1 se estourar
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import statistics
+
+
+def _preparar_ambiente(pasta):
+    # Precisa acontecer antes de importar main (configuração lida no import)
+    os.environ.update({
+        'DATABASE_URL':  f"sqlite:///{os.path.join(pasta, 'benchmark.db')}",
+        'UPLOAD_FOLDER': os.path.join(pasta, 'uploads'),
+        'RH_EMAIL':      'rh@benchmark.local',
+        'ADMIN_EMAIL':   '',
+        'MAIL_SERVER':   '',
+        'LOG_LEVEL':     'WARNING',
+    })
+
+
+def semear(main, n_denuncias, n_mensagens, rng):
+    db, Denuncia, MensagemChat = main.db, main.Denuncia, main.MensagemChat
+    protocolos = [f"{i:012X}" for i in range(1, n_denuncias + 1)]
+    status     = [rng.choice(main.STATUS_DENUNCIA) for _ in protocolos]
+    with main.app.app_context():
+        db.session.execute(db.insert(Denuncia), [
+            {'texto': f"Relato de teste número {i} sobre o setor {i % 37}", 'protocolo': p, 'status': st}
+            for i, (p, st) in enumerate(zip(protocolos, status))
+        ])
+        lote = []
+        for i in range(n_mensagens):
+            autor = rng.choice(['Usuário', 'RH'])
+            lote.append({'denuncia_id': rng.randint(1, n_denuncias), 'autor': autor,
+                         'texto': f"mensagem {i}", 'lida_pelo_rh': autor == 'RH' or rng.random() < 0.8})
+            if len(lote) == 5000:
+                db.session.execute(db.insert(MensagemChat), lote)
+                lote = []
+        if lote:
+            db.session.execute(db.insert(MensagemChat), lote)
+        nao_lidas = db.select(db.func.count(MensagemChat.id)).where(
+            MensagemChat.denuncia_id == Denuncia.id, MensagemChat.autor == 'Usuário',
+            MensagemChat.lida_pelo_rh == False
+        ).scalar_subquery()
+        db.session.execute(db.update(Denuncia).values(msgs_nao_lidas=nao_lidas))
+        db.session.commit()
+        if main.busca_dialeto:
+            main.reindexar_busca()
+    abertos = [p for p, st in zip(protocolos, status) if st != 'Finalizada']
+    return protocolos, abertos
+
+
+ENDPOINTS = {'admin': 'admin', 'admin_pagina': 'admin', 'admin_denuncia': 'admin_denuncia',
+             'consulta': 'consulta', 'chat': 'chat', 'upload': 'chat'}
+
+
+def cenarios(protocolos, abertos, rng):
+    anexo = os.urandom(256 * 1024)
+    def upload():
+        # Conteúdo diferente a cada envio para não cair na deduplicação
+        dados = anexo[:-8] + rng.getrandbits(64).to_bytes(8, 'big')
+        return {'mensagem': '', 'anexo': (io.BytesIO(dados), 'documento.pdf')}
+    return {
+        'admin':          ('GET',  lambda: '/admin', None),
+        'admin_pagina':   ('GET',  lambda: f'/admin?antes={len(protocolos) // 2}', None),
+        'admin_denuncia': ('GET',  lambda: f'/admin/denuncia/{rng.choice(protocolos)}', None),
+        'consulta':       ('GET',  lambda: f'/consulta?protocolo={rng.choice(protocolos)}', None),
+        'chat':           ('POST', lambda: f'/chat/{rng.choice(abertos)}', lambda: {'mensagem': 'nova mensagem'}),
+        'upload':         ('POST', lambda: f'/chat/{rng.choice(abertos)}', upload),
+    }
+
+
+def executar(main, protocolos, abertos, requisicoes, rng):
+    cliente = main.app.test_client()
+    with cliente.session_transaction() as s:
+        s['user'] = {'email': 'rh@benchmark.local'}
+        s['admin_verified'] = True
+    regras = {r.endpoint: r.rule for r in main.app.url_map.iter_rules()}
+    resultados = {}
+    for nome, (metodo, url, corpo) in cenarios(protocolos, abertos, rng).items():
+        # Consultas SQL por requisição, lidas da instrumentação do próprio app
+        rota = regras[ENDPOINTS[nome]]
+        sql_antes, req_antes = main.metricas.resumo('canal_sql_consultas_por_requisicao', rota=rota)
+        tempos = []
+        inicio = time.perf_counter()
+        for _ in range(requisicoes):
+            t0 = time.perf_counter()
+            resp = cliente.open(url(), method=metodo, data=corpo() if corpo else None,
+                                headers={'Accept': 'application/json'} if metodo == 'POST' else None)
+            resp.close()
+            tempos.append(time.perf_counter() - t0)
+            if resp.status_code >= 400:
+                raise SystemExit(f"{nome}: HTTP {resp.status_code}")
+        total = time.perf_counter() - inicio
+        sql_depois, req_depois = main.metricas.resumo('canal_sql_consultas_por_requisicao', rota=rota)
+        tempos.sort()
+        resultados[nome] = {
+            'requisicoes': requisicoes,
+            'vazao_rps':   round(requisicoes / total, 1),
+            'p50_ms':      round(statistics.median(tempos) * 1000, 2),
+            'p95_ms':      round(tempos[max(0, int(len(tempos) * 0.95) - 1)] * 1000, 2),
+            'max_ms':      round(tempos[-1] * 1000, 2),
+            'sql_por_req': round((sql_depois - sql_antes) / max(req_depois - req_antes, 1), 1),
+        }
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--denuncias', type=int, default=2000)
+    parser.add_argument('--mensagens', type=int, default=20000)
+    parser.add_argument('--requisicoes', type=int, default=100, help='Requisições por cenário.')
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--json', help='Grava os resultados neste arquivo.')
+    parser.add_argument('--limite-p95', action='append', default=[], metavar='CENARIO=MS',
+                        help='Falha (código 1) se o p95 do cenário passar do limite.')
+    args = parser.parse_args()
+
+    rng = random.Random(args.semente)
+    with tempfile.TemporaryDirectory() as pasta:
+        _preparar_ambiente(pasta)
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import main as app_main
+
+        t0 = time.perf_counter()
+        protocolos, abertos = semear(app_main, args.denuncias, args.mensagens, rng)
+        print(f"Banco semeado: {args.denuncias} denúncias, {args.mensagens} mensagens "
+              f"({time.perf_counter() - t0:.1f}s)")
+        resultados = executar(app_main, protocolos, abertos, args.requisicoes, rng)
+
+    print(f"\n{'cenário':<16}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'SQL/req':>9}")
+    for nome, r in resultados.items():
+        print(f"{nome:<16}{r['vazao_rps']:>9}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['max_ms']:>10}"
+              f"{r['sql_por_req']:>9}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'parametros': vars(args), 'resultados': resultados}, f, indent=2)
+
+    estouros = []
+    for limite in args.limite_p95:
+        nome, ms = limite.split('=', 1)
+        if nome in resultados and resultados[nome]['p95_ms'] > float(ms):
+            estouros.append(f"{nome}: p95 {resultados[nome]['p95_ms']}ms > {ms}ms")
+    if estouros:
+        print('\nRegressão de latência:\n  ' + '\n  '.join(estouros))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
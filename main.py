@@ -1,45 +1,114 @@
+import io
 import os
-import uuid
+import bisect
+import csv
+import gzip
+import json
+import time
+import re
+import hashlib
+import shutil
+import tempfile
+import mimetypes
 import secrets
 import logging
-from flask import Flask, redirect, url_for, session, request, render_template, flash, send_from_directory
+import click
+import smtplib
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from markupsafe import Markup, escape
+from flask import Flask, Request, redirect, url_for, session, request, render_template, flash, g, has_request_context, send_file, abort, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_mail import Mail, Message as MailMessage
 from functools import wraps
-from threading import Thread
+from threading import Thread, Event, Lock
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
+import midia
 
 # --- App e Logging ---
 app = Flask(__name__)
 app.config['PREFERRED_URL_SCHEME'] = 'https'
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').strip().upper())
 logging.getLogger().info("🚩 APP_VERSION: consulta-v2 🚩")
 
 # --- Configurações de Segurança e Banco de Dados ---
 app.secret_key = os.environ.get('FLASK_SECRET', 'segredosuperseguro@123').strip()
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///database.db').strip()
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+POR_PAGINA = int(os.environ.get('ADMIN_POR_PAGINA', 50))
+BUSCA_POR_PAGINA = 20
+# Atualização do chat: por padrão o navegador consulta /mensagens (cursor JSON) a cada
+# CHAT_POLL_SEGUNDOS. SSE (CHAT_SSE=1) prende um worker por conexão durante CHAT_STREAM_SEGUNDOS:
+# só ligue com gunicorn em worker threaded/assíncrono (-k gthread --threads N, ou gevent).
+CHAT_SSE              = os.environ.get('CHAT_SSE', '0').strip().lower() in ('1', 'true', 'yes')
+CHAT_POLL_SEGUNDOS    = float(os.environ.get('CHAT_POLL_SEGUNDOS', 5))
+CHAT_STREAM_SEGUNDOS  = int(os.environ.get('CHAT_STREAM_SEGUNDOS', 25))
+CHAT_STREAM_INTERVALO = float(os.environ.get('CHAT_STREAM_INTERVALO', 2))
 
 # --- Upload ---
-UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'uploads')
+UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', os.path.join(os.path.dirname(__file__), 'uploads'))
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
+UPLOAD_TMP = os.path.join(UPLOAD_FOLDER, 'tmp')   # mesmo disco: os.replace é atômico
+os.makedirs(UPLOAD_TMP, exist_ok=True)
 ALLOWED_EXTENSIONS = {'png','jpg','jpeg','gif','pdf','doc','docx','xls','xlsx','mp3','wav','ogg','mp4','webm','mov'}
+MB = 1024 * 1024
+# Limite por tipo de arquivo (bytes); extensões fora da tabela usam LIMITE_UPLOAD_PADRAO
+LIMITES_UPLOAD = {
+    **dict.fromkeys(['png','jpg','jpeg','gif'], int(os.environ.get('UPLOAD_MAX_IMAGEM_MB', 15)) * MB),
+    **dict.fromkeys(['mp3','wav','ogg'], int(os.environ.get('UPLOAD_MAX_AUDIO_MB', 40)) * MB),
+    **dict.fromkeys(['mp4','webm','mov'], int(os.environ.get('UPLOAD_MAX_VIDEO_MB', 200)) * MB),
+}
+LIMITE_UPLOAD_PADRAO = int(os.environ.get('UPLOAD_MAX_DOCUMENTO_MB', 20)) * MB
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['MAX_CONTENT_LENGTH'] = max(LIMITES_UPLOAD.values()) + MB
+# Entrega de anexos: '' (o próprio Flask), 'nginx' (X-Accel-Redirect) ou 'sendfile' (X-Sendfile).
+# Para nginx: location /_anexos/ { internal; alias /app/uploads/; }
+ANEXOS_OFFLOAD      = os.environ.get('ANEXOS_OFFLOAD', '').strip().lower()
+ANEXOS_ACCEL_PREFIX = os.environ.get('ANEXOS_ACCEL_PREFIX', '/_anexos/').strip()
+app.config['USE_X_SENDFILE'] = ANEXOS_OFFLOAD == 'sendfile'
+CACHE_ANEXOS = 'private, max-age=31536000, immutable'
+# Prévias (miniaturas, áudio Opus, capa de vídeo) geradas num pool de processos
+MIDIA_PROCESSOS       = int(os.environ.get('MIDIA_PROCESSOS', 1))
+MIDIA_COMPRIMIR_VIDEO = os.environ.get('MIDIA_COMPRIMIR_VIDEO', '0').strip().lower() in ('1', 'true', 'yes')
+# Arquivamento de casos finalizados (flask arquivar): anexos vão para o armazenamento frio,
+# com gzip só nos formatos que ainda não são comprimidos
+ARQUIVO_FRIO       = os.environ.get('ARQUIVO_FRIO', os.path.join(os.path.dirname(__file__), 'arquivo_frio'))
+ARQUIVAR_APOS_DIAS = int(os.environ.get('ARQUIVAR_APOS_DIAS', 180))
+COMPRIMIR_FRIO     = {'pdf', 'doc', 'xls', 'wav'}
 
 # --- Flask-Mail via ENV ---
 app.config.update(
     MAIL_SERVER   = os.environ.get('MAIL_SERVER', '').strip(),
     MAIL_PORT     = int(os.environ.get('MAIL_PORT', 465)),
-    MAIL_USE_SSL  = True,
+    MAIL_USE_SSL  = os.environ.get('MAIL_USE_SSL', '1').strip().lower() not in ('0', 'false', 'no'),
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME', '').strip(),
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD', '').strip(),
 )
 mail = Mail(app)
+# Fila de e-mails (persistida no banco, enviada por um pool pequeno de threads)
+MAIL_FILA_MAX       = int(os.environ.get('MAIL_FILA_MAX', 1000))
+MAIL_WORKERS        = int(os.environ.get('MAIL_WORKERS', 2))
+MAIL_LOTE           = int(os.environ.get('MAIL_LOTE', 20))
+MAIL_MAX_TENTATIVAS = int(os.environ.get('MAIL_MAX_TENTATIVAS', 6))
+MAIL_BACKOFF_BASE   = int(os.environ.get('MAIL_BACKOFF_BASE', 30))    # segundos, dobra a cada falha
+MAIL_INTERVALO      = int(os.environ.get('MAIL_INTERVALO', 15))       # varredura periódica da fila
+MAIL_RESERVA        = 300                                             # lease de um lote reservado
+MAIL_FALHAS_DIAS    = int(os.environ.get('MAIL_FALHAS_DIAS', 30))     # retenção dos e-mails desistidos
 db   = SQLAlchemy(app)
 
 # --- Models ---
+STATUS_DENUNCIA = ['Recebida', 'Em Andamento', 'Finalizada']
+STATUS_ARQUIVADA = 'Arquivada'   # filtro do painel e da exportação: só casos em denuncia_arquivada
+
 class Denuncia(db.Model):
     id         = db.Column(db.Integer, primary_key=True)
     texto      = db.Column(db.Text, nullable=False)
@@ -47,19 +116,161 @@ class Denuncia(db.Model):
     protocolo  = db.Column(db.String(20), unique=True, nullable=False)
     status     = db.Column(db.String(30), default='Recebida')
     observacao = db.Column(db.Text, nullable=True)
+    # Contadores mantidos junto com as escritas (evita GROUP BY no painel)
+    msgs_nao_lidas   = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    ultima_atividade = db.Column(db.DateTime, server_default=db.func.now())
+    __table_args__ = (
+        db.Index('ix_denuncia_data_hora_id', 'data_hora', 'id'),
+        db.Index('ix_denuncia_status_data_hora_id', 'status', 'data_hora', 'id'),
+        db.Index('ix_denuncia_status_ultima_atividade', 'status', 'ultima_atividade'),
+    )
 
 class MensagemChat(db.Model):
+    __table_args__ = (
+        db.Index('ix_mensagem_chat_denuncia_autor_lida', 'denuncia_id', 'autor', 'lida_pelo_rh'),
+        db.Index('ix_mensagem_chat_denuncia_data_hora', 'denuncia_id', 'data_hora'),
+    )
     id           = db.Column(db.Integer, primary_key=True)
     denuncia_id  = db.Column(db.Integer, db.ForeignKey('denuncia.id'), nullable=False)
     autor        = db.Column(db.String(30), nullable=False)
     texto        = db.Column(db.Text, nullable=True)
     data_hora    = db.Column(db.DateTime, server_default=db.func.now())
-    anexo        = db.Column(db.String(120), nullable=True)
+    anexo        = db.Column(db.String(120), db.ForeignKey('anexo.nome'), nullable=True)
     lida_pelo_rh = db.Column(db.Boolean, default=False)
     denuncia     = db.relationship('Denuncia', backref=db.backref('mensagens', lazy=True))
+    arquivo      = db.relationship('Anexo', lazy='joined')
+
+class Anexo(db.Model):
+    # nome = <sha256>.<ext> para arquivos novos; uploads antigos mantêm o nome uuid.
+    # O nome só existe no disco: a URL usa `publico`, aleatório, para não revelar o hash do conteúdo
+    __table_args__ = (db.Index('ix_anexo_publico', 'publico', unique=True),)
+    nome      = db.Column(db.String(120), primary_key=True)
+    publico   = db.Column(db.String(32), nullable=True)
+    sha256    = db.Column(db.String(64), nullable=True)
+    tamanho   = db.Column(db.BigInteger, nullable=True)
+    refs      = db.Column(db.Integer, nullable=False, default=0)
+    # Referências de casos arquivados: com refs = 0 o arquivo fica no armazenamento frio
+    refs_arquivo = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    criado_em = db.Column(db.DateTime, server_default=db.func.now())
+    # Preenchidos pelo pipeline de mídia; midia_status None = não é mídia
+    midia_status = db.Column(db.String(12), nullable=True)
+    tipo         = db.Column(db.String(10), nullable=True)
+    largura      = db.Column(db.Integer, nullable=True)
+    altura       = db.Column(db.Integer, nullable=True)
+    duracao      = db.Column(db.Float, nullable=True)
+    previa       = db.Column(db.String(120), nullable=True)
+    poster       = db.Column(db.String(120), nullable=True)
+
+class HistoricoStatus(db.Model):
+    __tablename__ = 'historico_status'
+    id          = db.Column(db.Integer, primary_key=True)
+    denuncia_id = db.Column(db.Integer, db.ForeignKey('denuncia.id'), nullable=False, index=True)
+    status      = db.Column(db.String(30), nullable=False)
+    data_hora   = db.Column(db.DateTime, server_default=db.func.now())
+
+class DenunciaArquivada(db.Model):
+    # Caso finalizado fora das tabelas quentes; o pacote (JSON gzip com denúncia, mensagens e
+    # histórico) é deferred e só é lido quando alguém abre o caso
+    __tablename__  = 'denuncia_arquivada'
+    __table_args__ = (db.Index('ix_denuncia_arquivada_data_hora_id', 'data_hora', 'id'),)
+    id           = db.Column(db.Integer, primary_key=True, autoincrement=False)   # id original da denúncia
+    protocolo    = db.Column(db.String(20), unique=True, nullable=False)
+    status       = db.Column(db.String(30), nullable=False)
+    data_hora    = db.Column(db.DateTime)
+    arquivada_em = db.Column(db.DateTime, server_default=db.func.now())
+    pacote       = db.deferred(db.Column(db.LargeBinary, nullable=False))
+    msgs_nao_lidas = 0   # mesma interface de Denuncia na listagem do painel
+
+class Exportacao(db.Model):
+    # Marca de cada exportação concluída, base do modo incremental
+    id       = db.Column(db.Integer, primary_key=True)
+    tipo     = db.Column(db.String(20), nullable=False, index=True)
+    iniciada = db.Column(db.DateTime, nullable=False)
+    linhas   = db.Column(db.Integer, nullable=False, default=0)
+
+class EmailAutorizado(db.Model):
+    # Autorizações gerenciadas sem deploy (flask autorizar / flask desautorizar)
+    email         = db.Column(db.String(254), primary_key=True)
+    papel         = db.Column(db.String(10), nullable=False, default='usuario')
+    atualizado_em = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
+
+class EmailPendente(db.Model):
+    __tablename__  = 'fila_email'
+    __table_args__ = (db.Index('ix_fila_email_status_proxima', 'status', 'proxima_tentativa'),)
+    id                = db.Column(db.Integer, primary_key=True)
+    destinatario      = db.Column(db.String(254), nullable=False)
+    assunto           = db.Column(db.String(200), nullable=False)
+    corpo             = db.Column(db.Text, nullable=False)
+    chave             = db.Column(db.String(120), nullable=True, index=True)
+    status            = db.Column(db.String(10), nullable=False, default='pendente')
+    tentativas        = db.Column(db.Integer, nullable=False, default=0)
+    proxima_tentativa = db.Column(db.DateTime, nullable=False)
+    erro              = db.Column(db.Text, nullable=True)
+
+# --- Schema ---
+def _adicionar_colunas(conn, tabela, colunas):
+    """ALTER TABLE para colunas novas em bancos já existentes (create_all não altera tabelas)."""
+    existentes = {c['name'] for c in db.inspect(conn).get_columns(tabela)}
+    novas = [nome for nome in colunas if nome not in existentes]
+    for nome in novas:
+        conn.execute(db.text(f'ALTER TABLE {tabela} ADD COLUMN {nome} {colunas[nome]}'))
+    return novas
+
+def _migrar_schema():
+    with db.engine.begin() as conn:
+        novas = _adicionar_colunas(conn, 'denuncia', {
+            'msgs_nao_lidas':   'INTEGER NOT NULL DEFAULT 0',
+            'ultima_atividade': 'TIMESTAMP',
+        })
+        if novas:
+            nao_lidas = db.select(db.func.count(MensagemChat.id)).where(
+                MensagemChat.denuncia_id == Denuncia.id,
+                MensagemChat.autor == 'Usuário',
+                MensagemChat.lida_pelo_rh == False
+            ).scalar_subquery()
+            ultima = db.select(db.func.max(MensagemChat.data_hora)).where(
+                MensagemChat.denuncia_id == Denuncia.id
+            ).scalar_subquery()
+            conn.execute(db.update(Denuncia).values(
+                msgs_nao_lidas=nao_lidas,
+                ultima_atividade=db.func.coalesce(ultima, Denuncia.data_hora)
+            ))
+        # Denúncias criadas num banco migrado antes de o insert preencher a coluna
+        conn.execute(db.update(Denuncia).where(Denuncia.ultima_atividade.is_(None))
+                     .values(ultima_atividade=Denuncia.data_hora))
+        _adicionar_colunas(conn, 'anexo', {
+            'midia_status': 'VARCHAR(12)',
+            'tipo':         'VARCHAR(10)',
+            'largura':      'INTEGER',
+            'altura':       'INTEGER',
+            'duracao':      'FLOAT',
+            'previa':       'VARCHAR(120)',
+            'poster':       'VARCHAR(120)',
+            'refs_arquivo': 'INTEGER NOT NULL DEFAULT 0',
+            'publico':      'VARCHAR(32)',
+        })
+        for model in (Denuncia, MensagemChat, Anexo):
+            for idx in model.__table__.indexes:
+                idx.create(conn, checkfirst=True)
+        # Registra uploads anteriores ao armazenamento por conteúdo (uma vez, com a tabela vazia)
+        if not conn.execute(db.select(Anexo.nome).limit(1)).first():
+            legados = db.select(MensagemChat.anexo, db.func.count()).where(
+                MensagemChat.anexo.isnot(None)
+            ).group_by(MensagemChat.anexo)
+            conn.execute(db.insert(Anexo).from_select(['nome', 'refs'], legados))
+        # Anexos anteriores ao nome público
+        for (nome,) in conn.execute(db.select(Anexo.nome).where(Anexo.publico.is_(None))).all():
+            conn.execute(db.update(Anexo).where(Anexo.nome == nome).values(publico=secrets.token_hex(16)))
+        # Denúncias anteriores ao histórico entram com o status atual
+        if not conn.execute(db.select(HistoricoStatus.id).limit(1)).first():
+            conn.execute(db.insert(HistoricoStatus).from_select(
+                ['denuncia_id', 'status', 'data_hora'],
+                db.select(Denuncia.id, db.func.coalesce(Denuncia.status, 'Recebida'), Denuncia.data_hora)
+            ))
 
 with app.app_context():
     db.create_all()
+    _migrar_schema()
 
 # --- Carrega listas de e-mails RH e Admin ---
 raw_rh       = os.environ.get('RH_EMAIL', '')
@@ -70,36 +281,910 @@ app.logger.debug(f"RAW_RH from ENV: {raw_rh!r}")
 app.logger.debug(f"Parsed RH_EMAILS: {RH_EMAILS}")
 
 # --- Autorizados adicionais ---
+AUTORIZADOS_ARQUIVO   = os.environ.get('AUTORIZADOS_ARQUIVO', 'autorizados.txt')
+AUTORIZADOS_VERIFICAR = float(os.environ.get('AUTORIZADOS_VERIFICAR_SEGUNDOS', 5))
+PAPEIS    = ('usuario', 'rh', 'admin')   # em ordem crescente de privilégio
+PAPEIS_RH = frozenset({'rh', 'admin'})
+
 def carregar_emails_autorizados(arquivo='autorizados.txt'):
     if not os.path.exists(arquivo):
         return []
     with open(arquivo, 'r', encoding='utf-8') as f:
         return [linha.strip().lower() for linha in f if linha.strip()]
-EMAILS_AUTORIZADOS = carregar_emails_autorizados()
 
-# --- Envio de E-mail ao RH ---
-def _send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+class RegistroAutorizacao:
+    """Mapa e-mail → papel montado a partir do ENV, de autorizados.txt e da tabela email_autorizado,
+    mais a tupla `rh` de destinatários dos avisos (RH_EMAIL e papel 'rh' na tabela).
+
+    Cada worker confere no máximo a cada AUTORIZADOS_VERIFICAR segundos se o mtime do arquivo ou
+    o carimbo da tabela mudaram e, nesse caso, troca o mapa inteiro de uma vez (sem restart).
+    """
+
+    def __init__(self, arquivo):
+        self.arquivo  = arquivo
+        self._papeis  = {}
+        self.rh       = ()
+        self._versao  = None
+        self._proxima = 0.0
+        self._lock    = Lock()
+
+    def _versao_atual(self):
+        try:
+            mtime = os.stat(self.arquivo).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        tabela = db.session.query(db.func.count(EmailAutorizado.email),
+                                  db.func.max(EmailAutorizado.atualizado_em)).one()
+        return mtime, tuple(tabela)
+
+    def _montar(self):
+        papeis = {}
+        # Avisos de denúncia vão para todo e-mail com papel RH, mesmo que também seja admin
+        rh = dict.fromkeys(RH_EMAILS)
+        def incluir(email, papel):
+            atual = papeis.get(email)
+            if atual is None or PAPEIS.index(papel) > PAPEIS.index(atual):
+                papeis[email] = papel
+        for email in carregar_emails_autorizados(self.arquivo):
+            incluir(email, 'usuario')
+        for a in EmailAutorizado.query:
+            incluir(a.email.lower(), a.papel if a.papel in PAPEIS else 'usuario')
+            if a.papel == 'rh':
+                rh[a.email.lower()] = None
+        for email in RH_EMAILS:
+            incluir(email, 'rh')
+        for email in ADMIN_EMAILS:
+            incluir(email, 'admin')
+        return papeis, tuple(rh)
+
+    def atualizar(self, forcar=False):
+        if not forcar and time.monotonic() < self._proxima:
+            return
+        # Só um thread recarrega; os demais seguem com o mapa atual
+        if not self._lock.acquire(blocking=forcar):
+            return
+        try:
+            self._proxima = time.monotonic() + AUTORIZADOS_VERIFICAR
+            versao = self._versao_atual()
+            if forcar or versao != self._versao:
+                papeis, rh = self._montar()
+                self._papeis, self.rh = papeis, rh
+                self._versao = versao
+                app.logger.info(f"Autorizações carregadas: {len(papeis)} e-mail(s)")
+        finally:
+            self._lock.release()
+
+    def papel(self, email):
+        return self._papeis.get(email.lower()) if email else None
+
+    def eh_rh(self, email):
+        return self.papel(email) in PAPEIS_RH
+
+autorizacoes = RegistroAutorizacao(AUTORIZADOS_ARQUIVO)
+with app.app_context():
+    autorizacoes.atualizar(forcar=True)
+
+@app.before_request
+def _atualizar_autorizacoes():
+    autorizacoes.atualizar()
+
+@app.cli.command('autorizar')
+@click.argument('email')
+@click.option('--papel', type=click.Choice(PAPEIS), default='usuario')
+def autorizar_command(email, papel):
+    """Autoriza um e-mail (vale para todos os workers em poucos segundos)."""
+    email = email.strip().lower()
+    a = db.session.get(EmailAutorizado, email) or EmailAutorizado(email=email)
+    a.papel = papel
+    db.session.add(a)
+    db.session.commit()
+    print(f"{email} autorizado como {papel}.")
 
+@app.cli.command('desautorizar')
+@click.argument('email')
+def desautorizar_command(email):
+    """Remove um e-mail da tabela de autorizações (ENV e autorizados.txt não são alterados)."""
+    n = EmailAutorizado.query.filter_by(email=email.strip().lower()).delete()
+    db.session.commit()
+    print(f"{n} autorização(ões) removida(s).")
+
+# --- Fila de E-mails ---
+def _agora():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def enfileirar_email(destinatario, assunto, corpo, chave=None, agrupar=False):
+    """Adiciona o e-mail à sessão corrente (o commit fica com quem chamou).
+
+    Sem `agrupar`, retorna False quando a fila está cheia ou já existe um aviso pendente com a
+    mesma chave. Com `agrupar`, o corpo é acrescentado ao aviso pendente da mesma chave e
+    destinatário; assim o aviso nunca é descartado e a fila guarda no máximo um por chave.
+    """
+    if not app.config['MAIL_SERVER']:
+        return False
+    if chave:
+        pendente = EmailPendente.query.filter_by(status='pendente', chave=chave, destinatario=destinatario).first()
+        if pendente and not agrupar:
+            return False
+        # UPDATE condicional: se um worker acabou de reservar o aviso (status 'enviando'), cria outro
+        if pendente and EmailPendente.query.filter_by(id=pendente.id, status='pendente').update(
+                {'corpo': EmailPendente.corpo + '\n\n' + corpo}, synchronize_session=False):
+            return True
+    if not agrupar and EmailPendente.query.filter(
+            EmailPendente.status.in_(('pendente', 'enviando'))).count() >= MAIL_FILA_MAX:
+        app.logger.warning(f"Fila de e-mail cheia ({MAIL_FILA_MAX}); aviso para {destinatario} descartado")
+        return False
+    db.session.add(EmailPendente(destinatario=destinatario, assunto=assunto, corpo=corpo,
+                                 chave=chave, proxima_tentativa=_agora()))
+    return True
+
+def _reservar_lote(limite):
+    """Reserva até `limite` e-mails vencidos; o UPDATE condicional evita envio duplicado entre workers.
+
+    Reservados ficam 'enviando' (nada mais é agrupado neles) até o lease vencer; um worker que
+    morreu no meio do envio tem o lote retomado depois de MAIL_RESERVA segundos.
+    """
+    agora = _agora()
+    ids = [i for (i,) in db.session.query(EmailPendente.id).filter(
+        EmailPendente.status.in_(('pendente', 'enviando')),
+        EmailPendente.proxima_tentativa <= agora
+    ).order_by(EmailPendente.proxima_tentativa).limit(limite)]
+    reservados = []
+    for i in ids:
+        n = EmailPendente.query.filter(
+            EmailPendente.id == i,
+            EmailPendente.status.in_(('pendente', 'enviando')),
+            EmailPendente.proxima_tentativa <= agora
+        ).update({
+            'status':            'enviando',
+            'proxima_tentativa': agora + timedelta(seconds=MAIL_RESERVA),
+            'tentativas':        EmailPendente.tentativas + 1,
+        }, synchronize_session=False)
+        if n:
+            reservados.append(i)
+    db.session.commit()
+    if not reservados:
+        return []
+    return EmailPendente.query.filter(EmailPendente.id.in_(reservados)).all()
+
+def _reagendar_email(e, erro):
+    e.erro = str(erro)[:500]
+    if e.tentativas >= MAIL_MAX_TENTATIVAS:
+        e.status = 'falhou'
+        app.logger.error(f"E-mail {e.id} para {e.destinatario} desistido após {e.tentativas} tentativas: {erro}")
+    else:
+        e.status = 'pendente'
+        e.proxima_tentativa = _agora() + timedelta(seconds=MAIL_BACKOFF_BASE * 2 ** (e.tentativas - 1))
+
+def limpar_falhas_email():
+    """Apaga e-mails desistidos há mais de MAIL_FALHAS_DIAS (proxima_tentativa = última tentativa)."""
+    EmailPendente.query.filter(
+        EmailPendente.status == 'falhou',
+        EmailPendente.proxima_tentativa < _agora() - timedelta(days=MAIL_FALHAS_DIAS)
+    ).delete(synchronize_session=False)
+    db.session.commit()
+
+def processar_fila_email(limite=MAIL_LOTE):
+    """Envia um lote reutilizando uma única conexão SMTP. Retorna quantos e-mails foram tentados."""
+    lote = _reservar_lote(limite)
+    if not lote:
+        return 0
+    restantes = list(lote)
+    try:
+        with mail.connect() as conn:
+            while restantes:
+                e = restantes[0]
+                try:
+                    conn.send(MailMessage(subject=e.assunto, sender=app.config['MAIL_USERNAME'],
+                                          recipients=[e.destinatario], body=e.corpo))
+                    db.session.delete(e)
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException) as erro:
+                    _reagendar_email(e, erro)
+                restantes.pop(0)
+    except Exception as erro:
+        # Falha de conexão: o que sobrou do lote volta para a fila com backoff
+        app.logger.warning(f"Falha no SMTP ({erro}); {len(restantes)} e-mail(s) reagendado(s)")
+        for e in restantes:
+            _reagendar_email(e, erro)
+    db.session.commit()
+    return len(lote)
+
+_fila_email_evento = Event()
+_fila_email_lock   = Lock()
+_fila_email_pid    = None
+
+def _worker_email():
+    while True:
+        _fila_email_evento.wait(timeout=MAIL_INTERVALO)
+        _fila_email_evento.clear()
+        try:
+            with app.app_context():
+                while processar_fila_email():
+                    pass
+                limpar_falhas_email()
+        except Exception:
+            app.logger.exception('Erro no worker da fila de e-mail')
+
+def iniciar_fila_email():
+    """Sobe o pool uma vez por processo do gunicorn; retorna False se não há SMTP configurado."""
+    global _fila_email_pid
+    if not app.config['MAIL_SERVER']:
+        return False
+    if _fila_email_pid != os.getpid():
+        with _fila_email_lock:
+            if _fila_email_pid != os.getpid():
+                _fila_email_pid = os.getpid()
+                for i in range(MAIL_WORKERS):
+                    Thread(target=_worker_email, name=f'fila-email-{i}', daemon=True).start()
+                _fila_email_evento.set()   # primeira varredura já, sem esperar MAIL_INTERVALO
+    return True
+
+@app.before_request
+def _iniciar_fila_email():
+    # Logo no primeiro request do worker: pendências e backoffs de antes de um restart são
+    # retomados pela varredura periódica, sem esperar um e-mail novo
+    iniciar_fila_email()
+
+def despertar_fila_email():
+    """Acorda os workers após um commit que enfileirou e-mails."""
+    if iniciar_fila_email():
+        _fila_email_evento.set()
+
+@app.cli.command('enviar-emails')
+def enviar_emails_command():
+    """Esvazia a fila de e-mails de forma síncrona (cron ou testes com SMTP local)."""
+    total = 0
+    while n := processar_fila_email():
+        total += n
+    limpar_falhas_email()
+    print(f"{total} e-mail(s) processado(s).")
+
+# --- Avisos ao RH ---
 def notify_rh(texto_denuncia, protocolo):
-    for rh in RH_EMAILS:
-        if rh:
-            msg = MailMessage(
-                subject='Nova denúncia recebida',
-                sender=app.config['MAIL_USERNAME'],
-                recipients=[rh],
-                body=f"Uma nova denúncia foi registrada:\n\nProtocolo: {protocolo}\n\n{texto_denuncia}"
-            )
-            Thread(target=_send_async_email, args=(app, msg)).start()
+    # Nunca descartado: com o SMTP fora, novas denúncias se juntam ao aviso ainda pendente
+    for rh in autorizacoes.rh:
+        enfileirar_email(
+            rh, 'Nova denúncia recebida',
+            f"Uma nova denúncia foi registrada:\n\nProtocolo: {protocolo}\n\n{texto_denuncia}",
+            chave='denuncias', agrupar=True
+        )
+
+def notify_rh_mensagem(protocolo):
+    # Uma rajada de mensagens no mesmo protocolo gera um único aviso pendente por destinatário
+    for rh in autorizacoes.rh:
+        enfileirar_email(
+            rh, 'Nova mensagem em denúncia',
+            f"Há nova mensagem do denunciante no protocolo {protocolo}.",
+            chave=f'chat:{protocolo}'
+        )
+
+# --- Contadores por denúncia ---
+def registrar_atividade(denuncia_id, novas_nao_lidas=0):
+    """Atualiza contador de não lidas e última atividade na transação corrente (UPDATE atômico)."""
+    Denuncia.query.filter_by(id=denuncia_id).update({
+        'msgs_nao_lidas':   Denuncia.msgs_nao_lidas + novas_nao_lidas,
+        'ultima_atividade': db.func.now(),
+    }, synchronize_session=False)
+
+def marcar_lidas_pelo_rh(d):
+    if not d.msgs_nao_lidas:
+        return
+    lidas = MensagemChat.query.filter_by(denuncia_id=d.id, autor='Usuário', lida_pelo_rh=False)\
+        .update({'lida_pelo_rh': True}, synchronize_session=False)
+    Denuncia.query.filter_by(id=d.id).update({
+        'msgs_nao_lidas': db.case((Denuncia.msgs_nao_lidas > lidas, Denuncia.msgs_nao_lidas - lidas), else_=0)
+    }, synchronize_session=False)
+    db.session.commit()
+
+# --- Atualização incremental do chat ---
+def mensagens_apos(denuncia_id, apos, limite=200):
+    """Mensagens com id > apos (cursor), em ordem de chegada."""
+    return MensagemChat.query.filter(
+        MensagemChat.denuncia_id == denuncia_id,
+        MensagemChat.id > apos
+    ).order_by(MensagemChat.id.asc()).limit(limite).all()
+
+def mensagem_json(m):
+    return {
+        'id':    m.id,
+        'autor': m.autor,
+        'texto': m.texto,
+        'anexo':  url_anexo(m.arquivo),
+        'tipo':   m.arquivo.tipo if m.arquivo else None,
+        'previa': url_anexo(m.arquivo, '_p'),
+        'poster': url_anexo(m.arquivo, '_c'),
+        'data':   m.data_hora.strftime('%d/%m %H:%M') if m.data_hora else '',
+    }
+
+def _cursor_chat():
+    # EventSource reenvia o último id recebido em Last-Event-ID ao reconectar
+    return request.headers.get('Last-Event-ID', type=int) or request.args.get('apos', 0, type=int)
+
+def _json_mensagens(d, rh=False):
+    msgs = mensagens_apos(d.id, _cursor_chat())
+    if rh:
+        marcar_lidas_pelo_rh(d)
+    return jsonify(status=d.status, mensagens=[mensagem_json(m) for m in msgs])
+
+def _stream_chat(denuncia_id, rh=False):
+    apos       = _cursor_chat()
+    status_pag = request.args.get('status')
+
+    @stream_with_context
+    def eventos():
+        nonlocal apos
+        yield 'retry: 1000\n\n'
+        fim = time.monotonic() + CHAT_STREAM_SEGUNDOS
+        while True:
+            d = db.session.get(Denuncia, denuncia_id)
+            if d is None:
+                # Arquivada durante o stream: o navegador recarrega e abre o pacote
+                yield f"event: status\ndata: {json.dumps('Finalizada')}\n\n"
+                return
+            if status_pag and d.status != status_pag:
+                yield f"event: status\ndata: {json.dumps(d.status)}\n\n"
+                return
+            msgs = mensagens_apos(denuncia_id, apos)
+            if msgs:
+                apos = msgs[-1].id
+                yield f"id: {apos}\nevent: mensagens\ndata: {json.dumps([mensagem_json(m) for m in msgs])}\n\n"
+                if rh:
+                    marcar_lidas_pelo_rh(d)
+            # Encerra a transação para enxergar commits de outros workers no próximo ciclo
+            db.session.rollback()
+            if time.monotonic() >= fim:
+                return
+            time.sleep(CHAT_STREAM_INTERVALO)
+
+    return app.response_class(eventos(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def quer_json():
+    return request.accept_mimetypes.best == 'application/json'
+
+@app.context_processor
+def _config_chat():
+    return {'chat_sse': CHAT_SSE, 'chat_poll_ms': int(CHAT_POLL_SEGUNDOS * 1000)}
+
+# --- Arquivamento de casos finalizados ---
+# `flask arquivar` (via cron) tira das tabelas quentes as denúncias finalizadas sem atividade há
+# ARQUIVAR_APOS_DIAS: cada caso vira uma linha em denuncia_arquivada com o pacote comprimido, e os
+# anexos que só ele usava vão para ARQUIVO_FRIO. consulta() e admin_denuncia() abrem o pacote sob
+# demanda; reabrir o caso pelo painel o devolve às tabelas quentes.
+def _iso(valor):
+    return valor.isoformat() if isinstance(valor, datetime) else valor
+
+def _data(valor):
+    return datetime.fromisoformat(valor) if valor else None
+
+def _montar_pacote(d, msgs, historico):
+    return gzip.compress(json.dumps({
+        'denuncia': {
+            'id': d.id, 'texto': d.texto, 'protocolo': d.protocolo, 'status': d.status,
+            'observacao': d.observacao, 'data_hora': _iso(d.data_hora), 'ultima_atividade': _iso(d.ultima_atividade),
+        },
+        'mensagens': [
+            {'id': m.id, 'autor': m.autor, 'texto': m.texto, 'data_hora': _iso(m.data_hora),
+             'anexo': m.anexo, 'lida_pelo_rh': bool(m.lida_pelo_rh)}
+            for m in msgs
+        ],
+        'historico': [{'status': h.status, 'data_hora': _iso(h.data_hora)} for h in historico],
+    }, ensure_ascii=False).encode())
+
+def ler_pacote(arq):
+    return json.loads(gzip.decompress(arq.pacote))
+
+def abrir_arquivada(arq):
+    """Retorna (denuncia, mensagens) do pacote com os atributos que os templates do chat usam."""
+    pacote = ler_pacote(arq)
+    dados  = pacote['denuncia']
+    denuncia = SimpleNamespace(**dict(dados, data_hora=_data(dados['data_hora']),
+                                      ultima_atividade=_data(dados['ultima_atividade'])),
+                               msgs_nao_lidas=0, arquivada_em=arq.arquivada_em)
+    nomes    = {m['anexo'] for m in pacote['mensagens'] if m['anexo']}
+    arquivos = {a.nome: a for a in Anexo.query.filter(Anexo.nome.in_(nomes))} if nomes else {}
+    msgs = [SimpleNamespace(**dict(m, data_hora=_data(m['data_hora'])), arquivo=arquivos.get(m['anexo']))
+            for m in pacote['mensagens']]
+    return denuncia, msgs
+
+def caminho_frio(nome):
+    """Mesma organização de uploads/ dentro de ARQUIVO_FRIO; formatos comprimíveis ganham .gz."""
+    relativo = os.path.relpath(caminho_anexo(nome), UPLOAD_FOLDER)
+    if nome.rsplit('.', 1)[-1].lower() in COMPRIMIR_FRIO:
+        relativo += '.gz'
+    return safe_join(ARQUIVO_FRIO, relativo)
+
+def _mover_arquivo(origem, destino):
+    """Move entre o armazenamento quente e o frio; .gz em só um dos lados indica (des)compressão."""
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    parcial = destino + '.parcial'
+    if origem.endswith('.gz') == destino.endswith('.gz'):
+        shutil.move(origem, parcial)
+    else:
+        abrir_origem  = gzip.open if origem.endswith('.gz') else open
+        abrir_destino = gzip.open if destino.endswith('.gz') else open
+        with abrir_origem(origem, 'rb') as entrada, abrir_destino(parcial, 'wb') as saida:
+            shutil.copyfileobj(entrada, saida, MB)
+    os.replace(parcial, destino)
+    if os.path.exists(origem):
+        os.unlink(origem)
+
+def congelar_anexo(a):
+    """Leva original, prévia e capa para o armazenamento frio."""
+    for nome in filter(None, (a.nome, a.previa, a.poster)):
+        if os.path.exists(caminho_anexo(nome)):
+            _mover_arquivo(caminho_anexo(nome), caminho_frio(nome))
+
+def descongelar_anexo(a):
+    for nome in filter(None, (a.nome, a.previa, a.poster)):
+        if not os.path.exists(caminho_anexo(nome)) and os.path.exists(caminho_frio(nome)):
+            _mover_arquivo(caminho_frio(nome), caminho_anexo(nome))
+
+def _arquivar_denuncia(denuncia_id):
+    """Arquiva um caso numa transação própria; False se ele foi reaberto no meio do caminho."""
+    d = db.session.get(Denuncia, denuncia_id)
+    if not d or d.status != 'Finalizada':
+        return False
+    msgs      = MensagemChat.query.filter_by(denuncia_id=d.id).order_by(MensagemChat.id.asc()).all()
+    historico = HistoricoStatus.query.filter_by(denuncia_id=d.id).order_by(HistoricoStatus.id.asc()).all()
+    anexos    = Counter(m.anexo for m in msgs if m.anexo)
+    db.session.add(DenunciaArquivada(id=d.id, protocolo=d.protocolo, status=d.status, data_hora=d.data_hora,
+                                     pacote=_montar_pacote(d, msgs, historico)))
+    db.session.flush()
+    MensagemChat.query.filter_by(denuncia_id=d.id).delete(synchronize_session=False)
+    HistoricoStatus.query.filter_by(denuncia_id=d.id).delete(synchronize_session=False)
+    # DELETE condicionado ao status: se o RH reabriu o caso depois da leitura, nada é arquivado
+    if not Denuncia.query.filter_by(id=d.id, status='Finalizada').delete(synchronize_session=False):
+        db.session.rollback()
+        return False
+    for nome, n in anexos.items():
+        Anexo.query.filter_by(nome=nome).update({
+            'refs': Anexo.refs - n, 'refs_arquivo': Anexo.refs_arquivo + n
+        }, synchronize_session=False)
+    db.session.commit()
+    # Só depois do commit: arquivos ainda usados por casos ativos continuam no disco quente
+    if anexos:
+        for a in Anexo.query.filter(Anexo.nome.in_(anexos), Anexo.refs <= 0):
+            congelar_anexo(a)
+    db.session.expunge_all()
+    return True
+
+def arquivar_finalizadas(dias=ARQUIVAR_APOS_DIAS, limite=None):
+    """Arquiva as denúncias finalizadas sem atividade há `dias`. Retorna quantas foram arquivadas."""
+    corte = _agora() - timedelta(days=dias)
+    # A denúncia de maior id fica: o SQLite reaproveitaria o id apagado na próxima denúncia
+    maior = db.session.query(db.func.max(Denuncia.id)).scalar()
+    ids = [i for (i,) in db.session.query(Denuncia.id).filter(
+        Denuncia.status == 'Finalizada',
+        Denuncia.ultima_atividade < corte,
+        Denuncia.id != maior
+    ).order_by(Denuncia.id.asc()).limit(limite)]
+    db.session.rollback()
+    return sum(_arquivar_denuncia(i) for i in ids)
+
+def restaurar_denuncia(arq):
+    """Devolve um caso arquivado às tabelas quentes (o RH mudou o status de um caso arquivado)."""
+    pacote = ler_pacote(arq)
+    dados  = pacote['denuncia']
+    d = Denuncia(id=arq.id, texto=dados['texto'], protocolo=dados['protocolo'], status=dados['status'],
+                 observacao=dados['observacao'], data_hora=_data(dados['data_hora']),
+                 ultima_atividade=_data(dados['ultima_atividade']),
+                 msgs_nao_lidas=sum(m['autor'] == 'Usuário' and not m['lida_pelo_rh'] for m in pacote['mensagens']))
+    db.session.delete(arq)
+    db.session.add(d)
+    db.session.flush()
+    # Mensagens ganham ids novos (o original pode ter sido reaproveitado); o índice do caso é refeito
+    msgs = [MensagemChat(denuncia_id=d.id, autor=m['autor'], texto=m['texto'], data_hora=_data(m['data_hora']),
+                         anexo=m['anexo'], lida_pelo_rh=m['lida_pelo_rh'])
+            for m in pacote['mensagens']]
+    db.session.add_all(msgs)
+    db.session.add_all([HistoricoStatus(denuncia_id=d.id, status=h['status'], data_hora=_data(h['data_hora']))
+                        for h in pacote['historico']])
+    db.session.flush()
+    if busca_dialeto:
+        db.session.execute(db.text(f"DELETE FROM {BUSCA_TABELA[busca_dialeto]} WHERE denuncia_id = :id"),
+                           {'id': d.id})
+        indexar_busca(d.id, d.texto)
+        for m in msgs:
+            indexar_busca(d.id, m.texto, m.id)
+    anexos = Counter(m.anexo for m in msgs if m.anexo)
+    for nome, n in anexos.items():
+        Anexo.query.filter_by(nome=nome).update({
+            'refs': Anexo.refs + n,
+            'refs_arquivo': db.case((Anexo.refs_arquivo > n, Anexo.refs_arquivo - n), else_=0)
+        }, synchronize_session=False)
+    db.session.commit()
+    if anexos:
+        for a in Anexo.query.filter(Anexo.nome.in_(anexos)):
+            descongelar_anexo(a)
+    return d
+
+@app.cli.command('arquivar')
+@click.option('--dias', type=int, default=ARQUIVAR_APOS_DIAS, show_default=True,
+              help='Dias sem atividade para arquivar um caso finalizado.')
+@click.option('--limite', type=int, help='Máximo de casos nesta execução.')
+def arquivar_command(dias, limite):
+    """Arquiva denúncias finalizadas antigas e leva seus anexos ao armazenamento frio."""
+    print(f"{arquivar_finalizadas(dias, limite)} denúncia(s) arquivada(s).")
+
+# --- Busca textual ---
+# SQLite: tabela FTS5 busca_fts. Postgres: busca_texto com tsvector gerado + índice GIN.
+# O índice é alimentado junto com cada insert (indexar_busca) e pode ser refeito com
+# `flask reindexar-busca`.
+_INICIO_TRECHO, _FIM_TRECHO = '\x02', '\x03'
+BUSCA_DDL = {
+    'sqlite': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS busca_fts USING fts5("
+        "texto, denuncia_id UNINDEXED, mensagem_id UNINDEXED, tokenize='unicode61 remove_diacritics 2')",
+    ],
+    'postgresql': [
+        "CREATE TABLE IF NOT EXISTS busca_texto ("
+        "id BIGSERIAL PRIMARY KEY, denuncia_id INTEGER NOT NULL, mensagem_id INTEGER, texto TEXT NOT NULL, "
+        "tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('portuguese', texto)) STORED)",
+        "CREATE INDEX IF NOT EXISTS ix_busca_texto_tsv ON busca_texto USING gin (tsv)",
+        "CREATE INDEX IF NOT EXISTS ix_busca_texto_denuncia ON busca_texto (denuncia_id)",
+    ],
+}
+BUSCA_TABELA = {'sqlite': 'busca_fts', 'postgresql': 'busca_texto'}
+BUSCA_SQL = {
+    'sqlite': f"""
+        SELECT denuncia_id, mensagem_id,
+               snippet(busca_fts, 0, '{_INICIO_TRECHO}', '{_FIM_TRECHO}', '…', 16) AS trecho
+        FROM busca_fts WHERE busca_fts MATCH :q
+        ORDER BY bm25(busca_fts) LIMIT :limite OFFSET :offset""",
+    'postgresql': f"""
+        SELECT denuncia_id, mensagem_id,
+               ts_headline('portuguese', texto, q,
+                           'StartSel={_INICIO_TRECHO}, StopSel={_FIM_TRECHO}, MaxWords=30, MinWords=10') AS trecho
+        FROM busca_texto, websearch_to_tsquery('portuguese', :q) q
+        WHERE tsv @@ q
+        ORDER BY ts_rank(tsv, q) DESC LIMIT :limite OFFSET :offset""",
+}
+busca_dialeto = None   # None = banco sem suporte; a busca fica desativada
+
+def _preparar_busca():
+    global busca_dialeto
+    dialeto = db.engine.dialect.name
+    if dialeto not in BUSCA_DDL:
+        app.logger.warning(f"Busca textual indisponível para o banco {dialeto}")
+        return
+    tabela = BUSCA_TABELA[dialeto]
+    try:
+        existia = db.inspect(db.engine).has_table(tabela)
+        with db.engine.begin() as conn:
+            for ddl in BUSCA_DDL[dialeto]:
+                conn.execute(db.text(ddl))
+    except Exception:
+        app.logger.exception('Não foi possível criar o índice de busca textual')
+        return
+    busca_dialeto = dialeto
+    if not existia:
+        reindexar_busca()
+
+def indexar_busca(denuncia_id, texto, mensagem_id=None):
+    """Acrescenta o texto ao índice na transação corrente."""
+    if busca_dialeto and texto:
+        db.session.execute(db.text(
+            f"INSERT INTO {BUSCA_TABELA[busca_dialeto]} (texto, denuncia_id, mensagem_id) "
+            "VALUES (:texto, :denuncia_id, :mensagem_id)"
+        ), {'texto': texto, 'denuncia_id': denuncia_id, 'mensagem_id': mensagem_id})
+
+def reindexar_busca():
+    """Refaz o índice inteiro com INSERT ... SELECT (sem trazer as linhas para o Python)."""
+    tabela = BUSCA_TABELA[busca_dialeto]
+    db.session.execute(db.text(f"DELETE FROM {tabela}"))
+    db.session.execute(db.text(
+        f"INSERT INTO {tabela} (texto, denuncia_id, mensagem_id) SELECT texto, id, NULL FROM denuncia"
+    ))
+    db.session.execute(db.text(
+        f"INSERT INTO {tabela} (texto, denuncia_id, mensagem_id) "
+        "SELECT texto, denuncia_id, id FROM mensagem_chat WHERE texto IS NOT NULL AND texto <> ''"
+    ))
+    # Casos arquivados só têm o texto dentro do pacote
+    for arq in DenunciaArquivada.query.options(db.undefer(DenunciaArquivada.pacote)).yield_per(100):
+        pacote = ler_pacote(arq)
+        indexar_busca(arq.id, pacote['denuncia']['texto'])
+        for m in pacote['mensagens']:
+            indexar_busca(arq.id, m['texto'], m['id'])
+    db.session.commit()
+
+def _consulta_fts5(termos):
+    # Cada palavra vira um termo entre aspas (sem sintaxe FTS vinda do usuário); a última aceita prefixo
+    palavras = re.findall(r'\w+', termos)
+    if not palavras:
+        return None
+    return ' '.join(f'"{p}"' for p in palavras) + '*'
+
+def _trecho_html(trecho):
+    return Markup(str(escape(trecho or ''))
+                  .replace(_INICIO_TRECHO, '<mark>').replace(_FIM_TRECHO, '</mark>'))
+
+def buscar(termos, pagina=1):
+    """Retorna (resultados, tem_proxima). Cada resultado traz a denúncia, a mensagem e o trecho."""
+    q = _consulta_fts5(termos) if busca_dialeto == 'sqlite' else termos.strip()
+    if not busca_dialeto or not q:
+        return [], False
+    linhas = db.session.execute(db.text(BUSCA_SQL[busca_dialeto]), {
+        'q': q, 'limite': BUSCA_POR_PAGINA + 1, 'offset': (pagina - 1) * BUSCA_POR_PAGINA
+    }).all()
+    tem_proxima = len(linhas) > BUSCA_POR_PAGINA
+    linhas      = linhas[:BUSCA_POR_PAGINA]
+    ids         = {l.denuncia_id for l in linhas}
+    denuncias   = {d.id: d for d in Denuncia.query.filter(Denuncia.id.in_(ids))}
+    if ids - denuncias.keys():
+        denuncias.update({d.id: d for d in DenunciaArquivada.query.filter(DenunciaArquivada.id.in_(ids - denuncias.keys()))})
+    resultados  = [
+        {'denuncia': denuncias[l.denuncia_id], 'mensagem_id': l.mensagem_id, 'trecho': _trecho_html(l.trecho)}
+        for l in linhas if l.denuncia_id in denuncias
+    ]
+    return resultados, tem_proxima
+
+with app.app_context():
+    _preparar_busca()
+
+@app.cli.command('reindexar-busca')
+def reindexar_busca_command():
+    """Reconstrói o índice de busca textual a partir das denúncias e mensagens."""
+    if not busca_dialeto:
+        print('Busca textual indisponível neste banco.')
+        return
+    reindexar_busca()
+    print('Índice de busca reconstruído.')
+
+# --- Exportação ---
+# Leitura em lotes (yield_per / cursor no servidor) e escrita incremental: a memória usada
+# não depende do número de linhas exportadas. Casos arquivados entram depois dos ativos,
+# lidos dos pacotes de denuncia_arquivada em lotes menores.
+EXPORT_LOTE = 1000
+EXPORT_LOTE_ARQUIVO = 100   # pacotes descomprimidos por vez
+EXPORT_COLUNAS = {
+    'denuncias': ['protocolo', 'data_hora', 'status', 'ultima_atividade', 'mensagens_total',
+                  'mensagens_usuario', 'mensagens_rh', 'historico_status', 'texto'],
+    'mensagens': ['chave', 'id', 'protocolo', 'status_denuncia', 'autor', 'data_hora', 'texto', 'anexo'],
+}
+
+def _chave_mensagem(protocolo, id):
+    # No SQLite o rowid de mensagem_chat é reaproveitado depois do arquivamento, então
+    # 'id' sozinho pode repetir entre ativas e arquivadas; protocolo + id não repete.
+    return f"{protocolo}:{id}"
+
+def _filtrar_exportacao(q, coluna_data, de=None, ate=None, status=None):
+    if de:
+        q = q.where(coluna_data >= de)
+    if ate:
+        q = q.where(coluna_data < ate + timedelta(days=1))
+    if status:
+        q = q.where(Denuncia.status == status)
+    return q
+
+def _no_periodo(valor, de=None, ate=None):
+    return (not de or (valor is not None and valor >= de)) and \
+           (not ate or (valor is not None and valor < ate + timedelta(days=1)))
+
+def _lotes_arquivados(ate=None, status=None, desde=None):
+    """Pacotes de denuncia_arquivada em lotes, só com os filtros que o SQL consegue aplicar;
+    o resto (datas dentro do pacote) fica com quem consome."""
+    q = db.select(DenunciaArquivada).options(db.undefer(DenunciaArquivada.pacote))
+    if ate:
+        # Nenhuma mensagem é anterior à própria denúncia
+        q = q.where(DenunciaArquivada.data_hora < ate + timedelta(days=1))
+    if status:
+        q = q.where(DenunciaArquivada.status == status)
+    if desde:
+        # Caso com atividade depois da marca só pode ter sido arquivado depois dela
+        q = q.where(DenunciaArquivada.arquivada_em >= desde)
+    resultado = db.session.execute(q.order_by(DenunciaArquivada.id)
+                                   .execution_options(yield_per=EXPORT_LOTE_ARQUIVO))
+    for lote in resultado.scalars().partitions():
+        yield [ler_pacote(arq) for arq in lote]
+
+def _denuncias_arquivadas(de=None, ate=None, status=None, desde=None):
+    for pacotes in _lotes_arquivados(ate, status, desde):
+        linhas = []
+        for p in pacotes:
+            dados, msgs = p['denuncia'], p['mensagens']
+            data_hora, ultima = _data(dados['data_hora']), _data(dados['ultima_atividade'])
+            if not _no_periodo(data_hora, de, ate) or (desde and (ultima is None or ultima < desde)):
+                continue
+            historico = sorted(p['historico'], key=lambda h: h['data_hora'] or '')
+            linhas.append({
+                'protocolo':         dados['protocolo'],
+                'data_hora':         data_hora,
+                'status':            dados['status'],
+                'ultima_atividade':  ultima,
+                'mensagens_total':   len(msgs),
+                'mensagens_usuario': sum(m['autor'] == 'Usuário' for m in msgs),
+                'mensagens_rh':      sum(m['autor'] == 'RH' for m in msgs),
+                'historico_status':  ' | '.join(f"{_data(h['data_hora']):%Y-%m-%d %H:%M} {h['status']}"
+                                                for h in historico),
+                'texto':             dados['texto'],
+            })
+        if linhas:
+            yield linhas
+
+def _mensagens_arquivadas(de=None, ate=None, status=None, desde=None):
+    for pacotes in _lotes_arquivados(ate, status, desde):
+        linhas = []
+        for p in pacotes:
+            for m in p['mensagens']:
+                data_hora = _data(m['data_hora'])
+                if not _no_periodo(data_hora, de, ate) or (desde and (data_hora is None or data_hora < desde)):
+                    continue
+                linhas.append({
+                    'chave': _chave_mensagem(p['denuncia']['protocolo'], m['id']),
+                    'id': m['id'], 'protocolo': p['denuncia']['protocolo'], 'status_denuncia': p['denuncia']['status'],
+                    'autor': m['autor'], 'data_hora': data_hora, 'texto': m['texto'], 'anexo': m['anexo'],
+                })
+        if linhas:
+            yield linhas
+
+def _lotes_denuncias(de=None, ate=None, status=None, desde=None):
+    if status == STATUS_ARQUIVADA:
+        yield from _denuncias_arquivadas(de, ate, None, desde)
+        return
+    q = db.select(Denuncia.id, Denuncia.protocolo, Denuncia.data_hora, Denuncia.status,
+                  Denuncia.ultima_atividade, Denuncia.texto)
+    q = _filtrar_exportacao(q, Denuncia.data_hora, de, ate, status)
+    if desde:
+        q = q.where(Denuncia.ultima_atividade >= desde)
+    resultado = db.session.execute(q.order_by(Denuncia.id).execution_options(yield_per=EXPORT_LOTE))
+    for lote in resultado.partitions():
+        ids = [r.id for r in lote]
+        contagens = {}
+        for denuncia_id, autor, n in db.session.execute(
+            db.select(MensagemChat.denuncia_id, MensagemChat.autor, db.func.count())
+            .where(MensagemChat.denuncia_id.in_(ids))
+            .group_by(MensagemChat.denuncia_id, MensagemChat.autor)
+        ):
+            contagens.setdefault(denuncia_id, {})[autor] = n
+        historico = {}
+        for h in db.session.execute(
+            db.select(HistoricoStatus.denuncia_id, HistoricoStatus.status, HistoricoStatus.data_hora)
+            .where(HistoricoStatus.denuncia_id.in_(ids))
+            .order_by(HistoricoStatus.data_hora, HistoricoStatus.id)
+        ):
+            historico.setdefault(h.denuncia_id, []).append(f"{h.data_hora:%Y-%m-%d %H:%M} {h.status}")
+        yield [{
+            'protocolo':         r.protocolo,
+            'data_hora':         r.data_hora,
+            'status':            r.status,
+            'ultima_atividade':  r.ultima_atividade,
+            'mensagens_total':   sum(contagens.get(r.id, {}).values()),
+            'mensagens_usuario': contagens.get(r.id, {}).get('Usuário', 0),
+            'mensagens_rh':      contagens.get(r.id, {}).get('RH', 0),
+            'historico_status':  ' | '.join(historico.get(r.id, [])),
+            'texto':             r.texto,
+        } for r in lote]
+    yield from _denuncias_arquivadas(de, ate, status, desde)
+
+def _lotes_mensagens(de=None, ate=None, status=None, desde=None):
+    if status == STATUS_ARQUIVADA:
+        yield from _mensagens_arquivadas(de, ate, None, desde)
+        return
+    q = db.select(MensagemChat.id, Denuncia.protocolo, Denuncia.status.label('status_denuncia'),
+                  MensagemChat.autor, MensagemChat.data_hora, MensagemChat.texto, MensagemChat.anexo)\
+        .join(Denuncia, Denuncia.id == MensagemChat.denuncia_id)
+    q = _filtrar_exportacao(q, MensagemChat.data_hora, de, ate, status)
+    if desde:
+        q = q.where(MensagemChat.data_hora >= desde)
+    resultado = db.session.execute(q.order_by(MensagemChat.id).execution_options(yield_per=EXPORT_LOTE))
+    for lote in resultado.partitions():
+        yield [{'chave': _chave_mensagem(r.protocolo, r.id), **r._asdict()} for r in lote]
+    yield from _mensagens_arquivadas(de, ate, status, desde)
+
+LOTES_EXPORTACAO = {'denuncias': _lotes_denuncias, 'mensagens': _lotes_mensagens}
+
+def _csv_em_blocos(tipo, lotes):
+    buf    = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_COLUNAS[tipo])
+    for lote in lotes:
+        writer.writerows([linha[c] for c in EXPORT_COLUNAS[tipo]] for linha in lote)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+class _SaidaParquet:
+    """Arquivo só de escrita que guarda os bytes até serem repassados ao cliente."""
+    closed = False
+
+    def __init__(self):
+        self._partes, self._pos = [], 0
+
+    def write(self, dados):
+        self._partes.append(bytes(dados))
+        self._pos += len(dados)
+        return len(dados)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drenar(self):
+        dados, self._partes = b''.join(self._partes), []
+        return dados
+
+def _parquet_em_blocos(tipo, lotes):
+    # pyarrow é pesado: importado só quando alguém exporta Parquet
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    texto, inteiro, instante = pa.string(), pa.int64(), pa.timestamp('us')
+    tipos = {'id': inteiro, 'data_hora': instante, 'ultima_atividade': instante,
+             'mensagens_total': inteiro, 'mensagens_usuario': inteiro, 'mensagens_rh': inteiro}
+    schema = pa.schema([(c, tipos.get(c, texto)) for c in EXPORT_COLUNAS[tipo]])
+    saida  = _SaidaParquet()
+    writer = pq.ParquetWriter(pa.PythonFile(saida, mode='w'), schema, compression='zstd')
+    for lote in lotes:
+        writer.write_table(pa.Table.from_pylist(lote, schema=schema))   # um row group por lote
+        yield saida.drenar()
+    writer.close()
+    yield saida.drenar()
+
+FORMATOS_EXPORTACAO = {
+    'csv':     (_csv_em_blocos, 'text/csv; charset=utf-8'),
+    'parquet': (_parquet_em_blocos, 'application/vnd.apache.parquet'),
+}
+
+def exportar(tipo, formato, de=None, ate=None, status=None, incremental=False):
+    """Gera os blocos do arquivo; no modo incremental só entra o que mudou desde a última
+    exportação incremental completa do mesmo tipo (linhas na fronteira podem se repetir,
+    nunca faltar). Só uma exportação incremental sem filtros grava a nova marca ao terminar:
+    exportações avulsas ou filtradas não podem avançar a base."""
+    inicio = db.session.scalar(db.select(db.func.now()))
+    desde  = None
+    if incremental:
+        desde = db.session.scalar(db.select(db.func.max(Exportacao.iniciada)).where(Exportacao.tipo == tipo))
+        if desde:
+            # Colunas com server_default têm resolução de segundos (SQLite): margem de 1s
+            desde -= timedelta(seconds=1)
+    contador = {'linhas': 0}
+    def lotes():
+        for lote in LOTES_EXPORTACAO[tipo](de, ate, status, desde):
+            contador['linhas'] += len(lote)
+            yield lote
+    escrever, _ = FORMATOS_EXPORTACAO[formato]
+    yield from escrever(tipo, lotes())
+    if incremental and not (de or ate or status):
+        db.session.add(Exportacao(tipo=tipo, iniciada=inicio, linhas=contador['linhas']))
+        db.session.commit()
+
+def _data_param(valor):
+    """Data AAAA-MM-DD de um parâmetro da URL; inválida é 400 (nunca vira exportação sem filtro)."""
+    if not valor:
+        return None
+    try:
+        return datetime.strptime(valor, '%Y-%m-%d')
+    except ValueError:
+        abort(400, description=f'Data inválida: {valor!r} (use AAAA-MM-DD).')
+
+@app.cli.command('exportar')
+@click.argument('saida', type=click.Path(dir_okay=False, writable=True))
+@click.option('--tipo', type=click.Choice(list(EXPORT_COLUNAS)), default='denuncias')
+@click.option('--formato', type=click.Choice(list(FORMATOS_EXPORTACAO)), default='csv')
+@click.option('--de', type=click.DateTime(formats=['%Y-%m-%d']), help='Data inicial (AAAA-MM-DD).')
+@click.option('--ate', type=click.DateTime(formats=['%Y-%m-%d']), help='Data final, inclusiva (AAAA-MM-DD).')
+@click.option('--status', type=click.Choice(STATUS_DENUNCIA + [STATUS_ARQUIVADA]))
+@click.option('--incremental', is_flag=True, help='Só o que mudou desde a última exportação.')
+def exportar_command(saida, tipo, formato, de, ate, status, incremental):
+    """Exporta denúncias ou mensagens para CSV/Parquet em streaming."""
+    modo = 'w' if formato == 'csv' else 'wb'
+    with open(saida, modo, **({'encoding': 'utf-8', 'newline': ''} if formato == 'csv' else {})) as f:
+        for bloco in exportar(tipo, formato, de, ate, status, incremental):
+            f.write(bloco)
+    print(f"Exportação gravada em {saida}.")
 
 # --- Decorators ---
 def login_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        user   = session.get('user')
-        allowed = set(EMAILS_AUTORIZADOS + RH_EMAILS + ADMIN_EMAILS)
-        if not user or user['email'].lower() not in allowed:
+        user = session.get('user')
+        if not user or autorizacoes.papel(user['email']) is None:
             flash('Acesso restrito apenas para usuários autorizados.', 'warning')
             return redirect(url_for('login'))
         return f(*args, **kwargs)
@@ -109,7 +1194,7 @@ def admin_pin_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         user = session.get('user')
-        if user and user['email'].lower() in RH_EMAILS + ADMIN_EMAILS:
+        if user and autorizacoes.eh_rh(user['email']):
             if session.get('pending_pin') or not session.get('admin_verified'):
                 return redirect(url_for('admin_verificacao'))
             return f(*args, **kwargs)
@@ -120,12 +1205,335 @@ def admin_pin_required(f):
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.',1)[1].lower() in ALLOWED_EXTENSIONS
 
+# --- Armazenamento de Anexos ---
+class _UploadEmDisco:
+    """Destino de um arquivo do multipart: grava em disco em blocos, calculando o SHA-256
+    e aplicando o limite do tipo enquanto os bytes chegam."""
+
+    def __init__(self, limite):
+        fd, self.caminho = tempfile.mkstemp(dir=UPLOAD_TMP)
+        self._f      = os.fdopen(fd, 'w+b')
+        self.sha256  = hashlib.sha256()
+        self.tamanho = 0
+        self.limite  = limite
+
+    def write(self, dados):
+        self.tamanho += len(dados)
+        if self.tamanho > self.limite:
+            raise RequestEntityTooLarge()
+        self.sha256.update(dados)
+        return self._f.write(dados)
+
+    def close(self):
+        self._f.close()
+        if os.path.exists(self.caminho):
+            os.unlink(self.caminho)
+
+    def __getattr__(self, nome):
+        return getattr(self._f, nome)
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        ext = filename.rsplit('.', 1)[1].lower() if filename and '.' in filename else ''
+        upload = _UploadEmDisco(LIMITES_UPLOAD.get(ext, LIMITE_UPLOAD_PADRAO))
+        self.__dict__.setdefault('_uploads', []).append(upload)
+        return upload
+
+    def close(self):
+        # Inclui uploads interrompidos (ex.: 413) que não chegaram a request.files
+        super().close()
+        for upload in self.__dict__.get('_uploads', ()):
+            upload.close()
+
+app.request_class = UploadRequest
+
+# <sha256>.<ext>, ou <sha256>_p.<ext> / <sha256>_c.jpg para prévia e capa geradas
+_NOME_POR_HASH = re.compile(r'^[0-9a-f]{64}(_[pc])?\.\w+$')
+_NOME_PUBLICO  = re.compile(r'^([0-9a-f]{32})(_[pc])?\.(\w+)$')
+
+def url_anexo(a, variante=''):
+    """URL pública do original (''), da prévia ('_p') ou da capa ('_c'); None se não existir."""
+    arquivo = a and {'': a.nome, '_p': a.previa, '_c': a.poster}[variante]
+    if not arquivo or not a.publico:
+        return None
+    return url_for('chat_arquivo', filename=f"{a.publico}{variante}.{arquivo.rsplit('.', 1)[-1]}")
+
+app.jinja_env.globals['url_anexo'] = url_anexo
+
+def caminho_anexo(nome):
+    """Arquivos por hash ficam em uploads/ab/cd/<nome>; uploads antigos continuam na raiz."""
+    if _NOME_POR_HASH.match(nome):
+        return os.path.join(UPLOAD_FOLDER, nome[:2], nome[2:4], nome)
+    return os.path.join(UPLOAD_FOLDER, nome)
+
+def _referenciar_anexo(nome, sha256=None, tamanho=None):
+    """Soma uma referência ao anexo; retorna True quando a linha acabou de ser criada."""
+    if Anexo.query.filter_by(nome=nome).update({'refs': Anexo.refs + 1}, synchronize_session=False):
+        return False
+    ext = nome.rsplit('.', 1)[1]
+    try:
+        with db.session.begin_nested():
+            db.session.add(Anexo(nome=nome, sha256=sha256, tamanho=tamanho, refs=1, publico=secrets.token_hex(16),
+                                 midia_status='pendente' if ext in midia.EXTENSOES_MIDIA else None))
+    except IntegrityError:
+        # Outro request gravou o mesmo conteúdo ao mesmo tempo
+        Anexo.query.filter_by(nome=nome).update({'refs': Anexo.refs + 1}, synchronize_session=False)
+        return False
+    return True
+
+def salvar_upload(file):
+    """Guarda o upload no armazenamento por conteúdo (deduplicado) e conta a referência
+    na transação corrente. Retorna o nome para MensagemChat.anexo ou None.
+
+    O arquivo entra no armazenamento antes do commit; se a transação falhar ele fica sem
+    linha em anexo e é removido por `flask limpar-anexos` (rodar via cron)."""
+    if not (file and file.filename and allowed_file(file.filename)):
+        return None
+    recebido = file.stream
+    ext      = file.filename.rsplit('.',1)[1].lower()
+    nome     = f"{recebido.sha256.hexdigest()}.{ext}"
+    destino  = caminho_anexo(nome)
+    if not os.path.exists(destino):
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        recebido.flush()
+        os.replace(recebido.caminho, destino)
+    if _referenciar_anexo(nome, recebido.sha256.hexdigest(), recebido.tamanho):
+        g.setdefault('midias_novas', []).append(nome)
+    return nome
+
+@app.cli.command('limpar-anexos')
+@click.option('--horas', type=float, default=1, show_default=True,
+              help='Idade mínima de um arquivo sem registro para ser removido.')
+def limpar_anexos_command(horas):
+    """Remove arquivos do armazenamento sem linha em anexo e sobras de uploads interrompidos."""
+    limite    = time.time() - horas * 3600
+    removidos = 0
+    for pasta, _, nomes in os.walk(UPLOAD_FOLDER):
+        antigos = [n for n in nomes if os.path.getmtime(os.path.join(pasta, n)) < limite]
+        if pasta == UPLOAD_TMP:
+            orfaos = antigos
+        else:
+            # Só arquivos por hash (uploads antigos na raiz não têm sha256); prévia e capa seguem o original
+            hashes     = {n[:64] for n in antigos if _NOME_POR_HASH.match(n)}
+            conhecidos = {h for (h,) in db.session.query(Anexo.sha256).filter(Anexo.sha256.in_(hashes))} if hashes else set()
+            orfaos     = [n for n in antigos if _NOME_POR_HASH.match(n) and n[:64] not in conhecidos]
+        for n in orfaos:
+            os.unlink(os.path.join(pasta, n))
+        removidos += len(orfaos)
+    print(f"{removidos} arquivo(s) removido(s).")
+
+# --- Pipeline de mídia ---
+_midia_lock         = Lock()
+_midia_executor     = None
+_midia_executor_pid = None
+
+def _executor_midia():
+    # forkserver: o filho não herda threads/conexões do worker web, só importa midia.py
+    global _midia_executor, _midia_executor_pid
+    with _midia_lock:
+        if _midia_executor_pid != os.getpid():
+            _midia_executor = ProcessPoolExecutor(MIDIA_PROCESSOS,
+                                                  mp_context=multiprocessing.get_context('forkserver'))
+            _midia_executor_pid = os.getpid()
+    return _midia_executor
+
+def _gravar_midia(nome, info):
+    Anexo.query.filter_by(nome=nome).update(info, synchronize_session=False)
+    db.session.commit()
+
+def _concluir_midia(nome, futuro):
+    with app.app_context():
+        try:
+            info = dict(futuro.result(), midia_status='pronta')
+        except Exception as erro:
+            app.logger.warning(f"Falha ao processar mídia {nome}: {erro}")
+            info = {'midia_status': 'falhou'}
+        _gravar_midia(nome, info)
+
+def agendar_midia(nome):
+    """Reserva o anexo (pendente → processando) e manda para o pool sem bloquear o request."""
+    reservado = Anexo.query.filter_by(nome=nome, midia_status='pendente')\
+        .update({'midia_status': 'processando'}, synchronize_session=False)
+    db.session.commit()
+    if not reservado:
+        return
+    futuro = _executor_midia().submit(midia.processar, caminho_anexo(nome), nome.rsplit('.', 1)[1],
+                                      MIDIA_COMPRIMIR_VIDEO)
+    futuro.add_done_callback(lambda f: _concluir_midia(nome, f))
+
+@app.after_request
+def _despachar_midias(resp):
+    for nome in g.pop('midias_novas', ()):
+        agendar_midia(nome)
+    return resp
+
+@app.cli.command('processar-midias')
+@click.option('--legados', is_flag=True, help='Inclui anexos enviados antes do pipeline de mídia.')
+def processar_midias_command(legados):
+    """Processa de forma síncrona as mídias pendentes ou interrompidas."""
+    filtro = Anexo.midia_status.in_(['pendente', 'processando'])
+    if legados:
+        filtro = db.or_(filtro, Anexo.midia_status.is_(None))
+    nomes = [n for (n,) in db.session.query(Anexo.nome).filter(filtro)
+             if n.rsplit('.', 1)[-1] in midia.EXTENSOES_MIDIA]
+    for nome in nomes:
+        try:
+            info = dict(midia.processar(caminho_anexo(nome), nome.rsplit('.', 1)[1], MIDIA_COMPRIMIR_VIDEO),
+                        midia_status='pronta')
+        except Exception as erro:
+            print(f"{nome}: {erro}")
+            info = {'midia_status': 'falhou'}
+        _gravar_midia(nome, info)
+    print(f"{len(nomes)} mídia(s) processada(s).")
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_grande_demais(e):
+    if quer_json():
+        return jsonify(erro='Arquivo acima do tamanho permitido para este tipo.'), 413
+    flash('Arquivo acima do tamanho permitido para este tipo.', 'danger')
+    return redirect(request.referrer or url_for('consulta'))
+
+# --- Instrumentação ---
+# Métricas por processo (cada worker do gunicorn expõe as suas) no formato texto do Prometheus.
+REQUISICAO_LENTA_MS = int(os.environ.get('REQUISICAO_LENTA_MS', 1000))
+METRICS_TOKEN       = os.environ.get('METRICS_TOKEN', '').strip()
+BUCKETS_SEGUNDOS    = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BUCKETS_CONSULTAS   = (1, 2, 5, 10, 20, 50, 100)
+
+def _escapar_label(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metricas:
+    def __init__(self):
+        self._lock        = Lock()
+        self._contadores  = {}   # (nome, labels) -> valor
+        self._histogramas = {}   # (nome, labels) -> [buckets, contagens, soma, total]
+        self._ajuda       = {}
+
+    def contar(self, nome, ajuda, valor=1, **labels):
+        chave = (nome, tuple(sorted(labels.items())))
+        with self._lock:
+            self._ajuda.setdefault(nome, ('counter', ajuda))
+            self._contadores[chave] = self._contadores.get(chave, 0) + valor
+
+    def observar(self, nome, ajuda, valor, buckets=BUCKETS_SEGUNDOS, **labels):
+        chave = (nome, tuple(sorted(labels.items())))
+        with self._lock:
+            self._ajuda.setdefault(nome, ('histogram', ajuda))
+            h = self._histogramas.setdefault(chave, [buckets, [0] * len(buckets), 0.0, 0])
+            i = bisect.bisect_left(buckets, valor)
+            if i < len(buckets):
+                h[1][i] += 1
+            h[2] += valor
+            h[3] += 1
+
+    def resumo(self, nome, **labels):
+        """(soma, total) de um histograma; usado pelo benchmark.py."""
+        h = self._histogramas.get((nome, tuple(sorted(labels.items()))))
+        return (h[2], h[3]) if h else (0.0, 0)
+
+    def texto(self):
+        def fmt(labels, extra=()):
+            pares = list(labels) + list(extra)
+            if not pares:
+                return ''
+            return '{' + ','.join(f'{k}="{_escapar_label(v)}"' for k, v in pares) + '}'
+        linhas = []
+        with self._lock:
+            for nome, (tipo, ajuda) in sorted(self._ajuda.items()):
+                linhas += [f'# HELP {nome} {ajuda}', f'# TYPE {nome} {tipo}']
+                for (n, labels), valor in sorted(self._contadores.items()):
+                    if n == nome:
+                        linhas.append(f'{nome}{fmt(labels)} {valor}')
+                for (n, labels), (buckets, contagens, soma, total) in sorted(self._histogramas.items()):
+                    if n != nome:
+                        continue
+                    acumulado = 0
+                    for limite, c in zip(buckets, contagens):
+                        acumulado += c
+                        linhas.append(f'{nome}_bucket{fmt(labels, [("le", limite)])} {acumulado}')
+                    linhas.append(f'{nome}_bucket{fmt(labels, [("le", "+Inf")])} {total}')
+                    linhas.append(f'{nome}_sum{fmt(labels)} {soma}')
+                    linhas.append(f'{nome}_count{fmt(labels)} {total}')
+        return '\n'.join(linhas) + '\n'
+
+metricas = Metricas()
+
+def _inicio_sql(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('inicio_sql', []).append(time.perf_counter())
+
+def _fim_sql(conn, cursor, statement, parameters, context, executemany):
+    duracao = time.perf_counter() - conn.info['inicio_sql'].pop()
+    if has_request_context() and 'sql_consultas' in g:
+        g.sql_consultas += 1
+        g.sql_segundos  += duracao
+    else:
+        metricas.contar('canal_sql_fora_de_requisicao_total', 'Consultas SQL fora de requisições (workers, CLI).')
+
+def _erro_sql(contexto):
+    # Statement que falhou não dispara after_cursor_execute: desempilha o início aqui
+    if contexto.connection is not None and contexto.connection.info.get('inicio_sql'):
+        contexto.connection.info['inicio_sql'].pop()
+    metricas.contar('canal_sql_erros_total', 'Consultas SQL que terminaram em erro.')
+
+with app.app_context():
+    event.listen(db.engine, 'before_cursor_execute', _inicio_sql)
+    event.listen(db.engine, 'after_cursor_execute', _fim_sql)
+    event.listen(db.engine, 'handle_error', _erro_sql)
+
+def _iniciar_medicao():
+    g.inicio_req    = time.perf_counter()
+    g.sql_consultas = 0
+    g.sql_segundos  = 0.0
+
+# Primeiro before_request: a conferência das autorizações e a subida da fila de e-mail,
+# registradas antes, entram na latência e nas consultas SQL da rota
+app.before_request_funcs.setdefault(None, []).insert(0, _iniciar_medicao)
+
+@app.after_request
+def _status_medicao(resp):
+    g.status_resp = resp.status_code
+    return resp
+
+@app.teardown_request
+def _registrar_medicao(erro=None):
+    # teardown roda também quando a view levanta exceção: 500s entram na contagem e na latência
+    if 'inicio_req' not in g:
+        return
+    duracao = time.perf_counter() - g.pop('inicio_req')
+    rota    = request.url_rule.rule if request.url_rule else 'sem_rota'
+    status  = 500 if erro is not None else g.get('status_resp', 500)
+    metricas.contar('canal_http_requisicoes_total', 'Requisições HTTP atendidas.',
+                    rota=rota, metodo=request.method, status=status)
+    metricas.observar('canal_http_duracao_segundos', 'Latência das requisições por rota.', duracao, rota=rota)
+    metricas.observar('canal_sql_consultas_por_requisicao', 'Consultas SQL por requisição.',
+                      g.sql_consultas, buckets=BUCKETS_CONSULTAS, rota=rota)
+    metricas.observar('canal_sql_duracao_por_requisicao_segundos', 'Tempo em SQL por requisição.',
+                      g.sql_segundos, rota=rota)
+    enviados = sum(u.tamanho for u in request.__dict__.get('_uploads', ()))
+    if enviados:
+        metricas.contar('canal_upload_bytes_total', 'Bytes de anexos recebidos.', enviados, rota=rota)
+    if duracao * 1000 >= REQUISICAO_LENTA_MS:
+        metricas.contar('canal_requisicoes_lentas_total', 'Requisições acima de REQUISICAO_LENTA_MS.', rota=rota)
+        app.logger.warning(f"Requisição lenta: {request.method} {rota} {duracao * 1000:.0f}ms, "
+                           f"{g.sql_consultas} SQL em {g.sql_segundos * 1000:.0f}ms")
+
+@app.route('/metrics')
+def metrics():
+    # Token Bearer para o Prometheus; sem token, só RH com PIN verificado
+    autorizado = METRICS_TOKEN and secrets.compare_digest(
+        request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}')
+    user = session.get('user')
+    if not autorizado and not (user and autorizacoes.eh_rh(user['email']) and session.get('admin_verified')):
+        abort(403)
+    return app.response_class(metricas.texto(), mimetype='text/plain; version=0.0.4')
+
 # --- Rotas ---
 @app.route('/admin_verificacao', methods=['GET','POST'])
 @login_required
 def admin_verificacao():
     user = session.get('user')
-    if not user or user['email'].lower() not in RH_EMAILS + ADMIN_EMAILS:
+    if not user or not autorizacoes.eh_rh(user['email']):
         flash('Acesso restrito ao RH.', 'danger')
         return redirect(url_for('login'))
     if request.method == 'POST':
@@ -148,9 +1556,10 @@ def login():
     if request.method == 'POST':
         email = request.form['email'].strip().lower()
         app.logger.debug(f"EMAIL DIGITADO: {email}")
-        if email in EMAILS_AUTORIZADOS or email in RH_EMAILS or email in ADMIN_EMAILS:
+        papel = autorizacoes.papel(email)
+        if papel:
             session['user'] = {'email': email}
-            if email in RH_EMAILS + ADMIN_EMAILS:
+            if papel in PAPEIS_RH:
                 session['pending_pin'] = True
                 session.pop('admin_verified', None)
                 return redirect(url_for('admin_verificacao'))
@@ -171,28 +1580,27 @@ def denuncia():
             flash('Você precisa aceitar os termos e condições.','warning')
             return render_template('denuncia.html')
         texto = request.form['texto']
-        file  = request.files.get('anexo')
-        anexo = None
-        if file and file.filename and allowed_file(file.filename):
-            ext   = file.filename.rsplit('.',1)[1].lower()
-            anexo = f"{uuid.uuid4().hex}.{ext}"
-            file.save(os.path.join(UPLOAD_FOLDER, anexo))
+        anexo = salvar_upload(request.files.get('anexo'))
         protocolo = secrets.token_hex(6).upper()
-        d = Denuncia(texto=texto, protocolo=protocolo)
+        # ultima_atividade explícita: em bancos migrados a coluna não tem DEFAULT
+        d = Denuncia(texto=texto, protocolo=protocolo, msgs_nao_lidas=1 if anexo else 0,
+                     ultima_atividade=db.func.now())
         db.session.add(d)
-        db.session.commit()
+        db.session.flush()
+        db.session.add(HistoricoStatus(denuncia_id=d.id, status=d.status or 'Recebida'))
+        indexar_busca(d.id, texto)
         if anexo:
             m = MensagemChat(denuncia_id=d.id, autor='Usuário', texto=None, anexo=anexo, lida_pelo_rh=False)
             db.session.add(m)
-            db.session.commit()
         notify_rh(texto, protocolo)
+        db.session.commit()
+        despertar_fila_email()
         flash('Denúncia enviada com sucesso! Anote o protocolo abaixo.', 'success')
         return render_template('denuncia.html', protocolo=protocolo)
     return render_template('denuncia.html')
 
 @app.route('/consulta', methods=['GET','POST'])
 def consulta():
-    app.logger.debug(f"[DEBUG] consulta() chamado — method={request.method}, form={request.form}, args={request.args}")
     denuncia = None
     msgs     = []
     proto    = None
@@ -202,91 +1610,203 @@ def consulta():
         proto = request.args.get('protocolo','').strip().upper()
     if proto:
         denuncia = Denuncia.query.filter_by(protocolo=proto).first()
-        if not denuncia:
-            flash('Protocolo não encontrado.','warning')
-        else:
+        arquivada = None if denuncia else DenunciaArquivada.query.filter_by(protocolo=proto).first()
+        if denuncia:
             msgs = MensagemChat.query.filter_by(denuncia_id=denuncia.id).order_by(MensagemChat.data_hora.asc()).all()
+        elif arquivada:
+            denuncia, msgs = abrir_arquivada(arquivada)
+        else:
+            flash('Protocolo não encontrado.','warning')
     return render_template('consulta.html', denuncia=denuncia, mensagens=msgs, protocolo=proto)
 
 @app.route('/chat/<protocolo>', methods=['POST'])
 def chat(protocolo):
     d = Denuncia.query.filter_by(protocolo=protocolo).first()
     if not d:
+        if quer_json():
+            return jsonify(erro='Protocolo não existe.'), 404
         flash('Protocolo não existe.','danger')
         return redirect(url_for('consulta'))
     if d.status == 'Finalizada':
+        if quer_json():
+            return jsonify(erro='Conversa encerrada.'), 409
         flash('Conversa encerrada.','danger')
         return redirect(url_for('consulta', protocolo=protocolo))
     texto = request.form.get('mensagem','').strip()
-    file  = request.files.get('anexo')
-    anexo = None
-
     # Aceita qualquer arquivo (inclui áudio .webm do gravador)
-    if file and file.filename and allowed_file(file.filename):
-        ext   = file.filename.rsplit('.',1)[1].lower()
-        anexo = f"{uuid.uuid4().hex}.{ext}"
-        file.save(os.path.join(UPLOAD_FOLDER, anexo))
+    anexo = salvar_upload(request.files.get('anexo'))
 
+    m = None
     if texto or anexo:
         m = MensagemChat(denuncia_id=d.id, autor='Usuário', texto=texto or None, anexo=anexo, lida_pelo_rh=False)
         db.session.add(m)
+        db.session.flush()
+        indexar_busca(d.id, texto, m.id)
+        registrar_atividade(d.id, novas_nao_lidas=1)
+        notify_rh_mensagem(protocolo)
         db.session.commit()
+        despertar_fila_email()
+    if quer_json():
+        return jsonify(id=m.id if m else None)
     return redirect(url_for('consulta', protocolo=protocolo))
 
+@app.route('/chat/<protocolo>/mensagens')
+def chat_mensagens(protocolo):
+    d = Denuncia.query.filter_by(protocolo=protocolo).first_or_404()
+    return _json_mensagens(d)
+
+@app.route('/chat/<protocolo>/eventos')
+def chat_eventos(protocolo):
+    if not CHAT_SSE:
+        abort(404)
+    d = Denuncia.query.filter_by(protocolo=protocolo).first_or_404()
+    return _stream_chat(d.id)
+
 @app.route('/chat_arquivo/<filename>')
 def chat_arquivo(filename):
-    return send_from_directory(UPLOAD_FOLDER, filename)
+    # <publico>.<ext> é o original; <publico>_p.<ext> e <publico>_c.jpg, prévia e capa
+    partes = _NOME_PUBLICO.match(filename)
+    a = Anexo.query.filter_by(publico=partes.group(1)).first() if partes else None
+    arquivo = a and {'': a.nome, '_p': a.previa, '_c': a.poster}[partes.group(2) or '']
+    if not arquivo or arquivo.rsplit('.', 1)[-1] != partes.group(3):
+        abort(404)
+    relativo = os.path.relpath(caminho_anexo(arquivo), UPLOAD_FOLDER)
+    caminho  = safe_join(UPLOAD_FOLDER, relativo)
+    # O conteúdo por trás do nome público nunca muda: ETag forte e cache imutável
+    etag = filename.rsplit('.', 1)[0]
+    if not caminho or not os.path.isfile(caminho):
+        frio = caminho_frio(arquivo)
+        if not frio or not os.path.isfile(frio):
+            abort(404)
+        # Anexo de caso arquivado: sempre pelo Flask; o .gz é descomprimido em streaming (sem Range)
+        resp = send_file(gzip.open(frio, 'rb') if frio.endswith('.gz') else frio, etag=etag, conditional=True,
+                         mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    elif ANEXOS_OFFLOAD == 'nginx':
+        if etag in request.if_none_match:
+            resp = app.response_class(status=304)
+        else:
+            resp = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+            resp.headers['X-Accel-Redirect'] = ANEXOS_ACCEL_PREFIX.rstrip('/') + '/' + relativo.replace(os.sep, '/')
+        resp.set_etag(etag)
+    else:
+        # conditional=True responde 304 e 206 (Range) para seek de áudio/vídeo
+        resp = send_file(caminho, etag=etag, conditional=True)
+    resp.headers['Cache-Control'] = CACHE_ANEXOS
+    return resp
 
 @app.route('/admin', methods=['GET','POST'])
 @login_required
 @admin_pin_required
 def admin():
-    subq = db.session.query(
-        MensagemChat.denuncia_id.label('denuncia_id'),
-        db.func.count().label('novas_msgs')
-    ).filter(
-        MensagemChat.autor=='Usuário',
-        MensagemChat.lida_pelo_rh==False
-    ).group_by(MensagemChat.denuncia_id).subquery()
-    rows = db.session.query(Denuncia, subq.c.novas_msgs)\
-        .outerjoin(subq, Denuncia.id==subq.c.denuncia_id)\
-        .order_by(Denuncia.data_hora.desc()).all()
-    denuncias     = [r[0] for r in rows]
-    unread_counts = {r[0].protocolo: int(r[1] or 0) for r in rows}
-    return render_template('admin.html', denuncias=denuncias, unread_counts=unread_counts)
+    status = request.args.get('status')
+    if status not in STATUS_DENUNCIA and status != STATUS_ARQUIVADA:
+        status = None
+    # Casos arquivados ficam numa tabela própria, fora da listagem normal
+    modelo = DenunciaArquivada if status == STATUS_ARQUIVADA else Denuncia
+    q = modelo.query
+    if status in STATUS_DENUNCIA:
+        q = q.filter(Denuncia.status == status)
+    # Paginação por keyset: (data_hora, id) da última linha da página anterior
+    antes = request.args.get('antes', type=int)
+    ref   = db.session.get(modelo, antes) if antes else None
+    if ref:
+        q = q.filter(db.or_(
+            modelo.data_hora < ref.data_hora,
+            db.and_(modelo.data_hora == ref.data_hora, modelo.id < ref.id)
+        ))
+    denuncias = q.order_by(modelo.data_hora.desc(), modelo.id.desc()).limit(POR_PAGINA + 1).all()
+    proximo = None
+    if len(denuncias) > POR_PAGINA:
+        denuncias = denuncias[:POR_PAGINA]
+        proximo   = denuncias[-1].id
+    return render_template('admin.html', denuncias=denuncias, status=status,
+                           status_opcoes=STATUS_DENUNCIA + [STATUS_ARQUIVADA], proximo=proximo, paginado=bool(ref))
+
+@app.route('/admin/exportar')
+@login_required
+@admin_pin_required
+def admin_exportar():
+    tipo    = request.args.get('tipo', 'denuncias')
+    formato = request.args.get('formato', 'csv')
+    status  = request.args.get('status')
+    if tipo not in EXPORT_COLUNAS or formato not in FORMATOS_EXPORTACAO:
+        abort(400)
+    # Status desconhecido é erro: ignorá-lo exportaria tudo (e avançaria a marca incremental)
+    if status and status not in STATUS_DENUNCIA + [STATUS_ARQUIVADA]:
+        abort(400)
+    gerador = exportar(tipo, formato,
+                       de=_data_param(request.args.get('de')),
+                       ate=_data_param(request.args.get('ate')),
+                       status=status or None,
+                       incremental=request.args.get('incremental', '').strip().lower() in ('1', 'true', 'yes', 'on'))
+    nome = f"{tipo}_{datetime.now():%Y%m%d_%H%M}.{formato}"
+    return app.response_class(stream_with_context(gerador), mimetype=FORMATOS_EXPORTACAO[formato][1],
+                              headers={'Content-Disposition': f'attachment; filename="{nome}"'})
+
+@app.route('/admin/busca')
+@login_required
+@admin_pin_required
+def admin_busca():
+    termos = request.args.get('q', '').strip()
+    pagina = max(request.args.get('pagina', 1, type=int), 1)
+    resultados, tem_proxima = buscar(termos, pagina) if termos else ([], False)
+    return render_template('admin_busca.html', q=termos, pagina=pagina, resultados=resultados,
+                           tem_proxima=tem_proxima, disponivel=busca_dialeto is not None)
 
 @app.route('/admin/denuncia/<protocolo>', methods=['GET','POST'])
 @login_required
 @admin_pin_required
 def admin_denuncia(protocolo):
-    d    = Denuncia.query.filter_by(protocolo=protocolo).first_or_404()
-    msgs = MensagemChat.query.filter_by(denuncia_id=d.id).order_by(MensagemChat.data_hora.asc()).all()
+    d    = Denuncia.query.filter_by(protocolo=protocolo).first()
     status_msg = None
-    if request.method=='POST' and 'atualizar_status' in request.form:
-        ns = request.form.get('novo_status')
-        if ns in ['Recebida','Em Andamento','Finalizada']:
-            d.status = ns
-            db.session.commit()
-            status_msg = f'Status: {ns}'
-    MensagemChat.query.filter_by(denuncia_id=d.id, autor='Usuário', lida_pelo_rh=False)\
-        .update({'lida_pelo_rh': True})
-    db.session.commit()
+    ns   = request.form.get('novo_status') if request.method=='POST' and 'atualizar_status' in request.form else None
+    if d is None:
+        arq = DenunciaArquivada.query.filter_by(protocolo=protocolo).first_or_404()
+        if ns not in STATUS_DENUNCIA or ns == arq.status:
+            denuncia, msgs = abrir_arquivada(arq)
+            return render_template('admin_chat.html', denuncia=denuncia, mensagens=msgs, status_msg=None)
+        # Reaberto pelo RH: volta às tabelas quentes e segue o fluxo normal
+        d = restaurar_denuncia(arq)
+    if ns in STATUS_DENUNCIA and ns != d.status:
+        d.status = ns
+        db.session.add(HistoricoStatus(denuncia_id=d.id, status=ns))
+        registrar_atividade(d.id)
+        db.session.commit()
+        status_msg = f'Status: {ns}'
+    marcar_lidas_pelo_rh(d)
     # Chat do RH, aceita texto + anexo (inclui áudio do gravador)
     if request.method=='POST' and 'mensagem' in request.form and 'atualizar_status' not in request.form:
         texto = request.form.get('mensagem','').strip()
-        file  = request.files.get('anexo')
-        fname = None
-
-        if file and file.filename and allowed_file(file.filename):
-            ext   = file.filename.rsplit('.',1)[1].lower()
-            fname = f"{uuid.uuid4().hex}.{ext}"
-            file.save(os.path.join(UPLOAD_FOLDER, fname))
+        fname = salvar_upload(request.files.get('anexo'))
+        nm    = None
         if texto or fname:
             nm = MensagemChat(denuncia_id=d.id, autor='RH', texto=texto, anexo=fname, lida_pelo_rh=True)
             db.session.add(nm)
+            db.session.flush()
+            indexar_busca(d.id, texto, nm.id)
+            registrar_atividade(d.id)
             db.session.commit()
+        if quer_json():
+            return jsonify(id=nm.id if nm else None)
         return redirect(url_for('admin_denuncia', protocolo=protocolo))
+    msgs = MensagemChat.query.filter_by(denuncia_id=d.id).order_by(MensagemChat.data_hora.asc()).all()
     return render_template('admin_chat.html', denuncia=d, mensagens=msgs, status_msg=status_msg)
 
+@app.route('/admin/denuncia/<protocolo>/mensagens')
+@login_required
+@admin_pin_required
+def admin_denuncia_mensagens(protocolo):
+    d = Denuncia.query.filter_by(protocolo=protocolo).first_or_404()
+    return _json_mensagens(d, rh=True)
+
+@app.route('/admin/denuncia/<protocolo>/eventos')
+@login_required
+@admin_pin_required
+def admin_denuncia_eventos(protocolo):
+    if not CHAT_SSE:
+        abort(404)
+    d = Denuncia.query.filter_by(protocolo=protocolo).first_or_404()
+    return _stream_chat(d.id, rh=True)
+
 if __name__ == '__main__':
     app.run(debug=True)
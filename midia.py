@@ -0,0 +1,99 @@
+"""Geração de versões leves dos anexos (miniaturas, áudio Opus, capa de vídeo).
+
+Roda nos processos do ProcessPoolExecutor aberto por main.py, por isso não importa o app:
+o processo filho carrega só este módulo, o Pillow e chama ffmpeg/ffprobe quando existirem.
+"""
+import os
+import json
+import shutil
+import subprocess
+from PIL import Image, ImageOps
+
+IMAGENS = {'png', 'jpg', 'jpeg', 'gif'}
+AUDIOS  = {'mp3', 'wav', 'ogg'}
+VIDEOS  = {'mp4', 'mov'}
+AMBIGUOS = {'webm'}   # o gravador do chat gera áudio .webm; celulares enviam vídeo .webm
+EXTENSOES_MIDIA = IMAGENS | AUDIOS | VIDEOS | AMBIGUOS
+
+LADO_MINIATURA = 480
+FFMPEG_TIMEOUT = 600
+
+
+def _ffprobe(caminho):
+    if not shutil.which('ffprobe'):
+        return None
+    saida = subprocess.run(
+        ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', caminho],
+        capture_output=True, timeout=60, check=True
+    ).stdout
+    return json.loads(saida)
+
+
+def _ffmpeg(*args, destino):
+    """Roda o ffmpeg gravando num arquivo temporário e move para `destino` ao final."""
+    raiz, ext = os.path.splitext(destino)
+    parcial = f"{raiz}.parcial{ext}"
+    try:
+        subprocess.run(['ffmpeg', '-y', '-v', 'error', *args, parcial],
+                       capture_output=True, timeout=FFMPEG_TIMEOUT, check=True)
+        os.replace(parcial, destino)
+    finally:
+        if os.path.exists(parcial):
+            os.unlink(parcial)
+
+
+def _miniatura(caminho, destino):
+    with Image.open(caminho) as img:
+        largura, altura = img.size
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((LADO_MINIATURA, LADO_MINIATURA))
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        parcial = destino + '.parcial'
+        img.save(parcial, 'JPEG', quality=80, optimize=True)
+        os.replace(parcial, destino)
+    return largura, altura
+
+
+def processar(caminho, ext, comprimir_video=False):
+    """Gera as versões leves ao lado do original e devolve os metadados.
+
+    Os arquivos gerados usam o nome do original sem extensão mais `_p` (prévia) ou `_c`
+    (capa de vídeo); o dicionário traz só os nomes (sem diretório).
+    """
+    pasta = os.path.dirname(caminho)
+    base  = os.path.splitext(os.path.basename(caminho))[0]
+    info  = {'tipo': None, 'largura': None, 'altura': None, 'duracao': None, 'previa': None, 'poster': None}
+
+    if ext in IMAGENS:
+        info['tipo'] = 'imagem'
+        info['largura'], info['altura'] = _miniatura(caminho, os.path.join(pasta, f"{base}_p.jpg"))
+        info['previa'] = f"{base}_p.jpg"
+        return info
+
+    sonda = _ffprobe(caminho)
+    if sonda is None:
+        # Sem ffmpeg na máquina: só classifica pela extensão
+        info['tipo'] = 'video' if ext in VIDEOS else 'audio'
+        return info
+    video = next((s for s in sonda.get('streams', []) if s.get('codec_type') == 'video'), None)
+    info['duracao'] = float(sonda.get('format', {}).get('duration') or 0) or None
+
+    if video is None:
+        info['tipo'] = 'audio'
+        _ffmpeg('-i', caminho, '-vn', '-c:a', 'libopus', '-b:a', '32k',
+                destino=os.path.join(pasta, f"{base}_p.webm"))
+        info['previa'] = f"{base}_p.webm"
+        return info
+
+    info['tipo'] = 'video'
+    info['largura'], info['altura'] = video.get('width'), video.get('height')
+    _ffmpeg('-ss', str(min(1.0, (info['duracao'] or 0) / 2)), '-i', caminho, '-frames:v', '1',
+            '-vf', f"scale='min({LADO_MINIATURA},iw)':-2", destino=os.path.join(pasta, f"{base}_c.jpg"))
+    info['poster'] = f"{base}_c.jpg"
+    if comprimir_video:
+        _ffmpeg('-i', caminho, '-vf', "scale='min(1280,iw)':-2", '-c:v', 'libx264', '-crf', '28',
+                '-preset', 'veryfast', '-c:a', 'aac', '-b:a', '64k', '-movflags', '+faststart',
+                destino=os.path.join(pasta, f"{base}_p.mp4"))
+        info['previa'] = f"{base}_p.mp4"
+    return info
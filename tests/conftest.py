@@ -0,0 +1,24 @@
+import os
+import socket
+import sys
+import tempfile
+
+# main.py lê a configuração do ambiente na importação: banco, uploads e SMTP dos testes
+# precisam estar definidos antes do primeiro `import main`.
+_tmp = tempfile.mkdtemp(prefix='canal-denuncias-testes-')
+
+def _porta_livre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+os.environ.update({
+    'DATABASE_URL':  f"sqlite:///{os.path.join(_tmp, 'testes.db')}",
+    'UPLOAD_FOLDER': os.path.join(_tmp, 'uploads'),
+    'ARQUIVO_FRIO':  os.path.join(_tmp, 'arquivo_frio'),
+    'MAIL_SERVER':   '127.0.0.1',
+    'MAIL_PORT':     str(_porta_livre()),
+    'MAIL_USE_SSL':  '0',
+    'MAIL_USERNAME': 'canal@teste.local',
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
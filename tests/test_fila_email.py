@@ -0,0 +1,128 @@
+"""Fila de e-mails contra um SMTP local (aiosmtpd), sem SSL."""
+import os
+import pytest
+
+Controller = pytest.importorskip('aiosmtpd.controller').Controller
+
+import main
+from main import app, db, EmailPendente
+
+
+class _Caixa:
+    def __init__(self):
+        self.recebidos = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.recebidos.append((envelope.rcpt_tos, envelope.content.decode()))
+        return '250 OK'
+
+
+@pytest.fixture
+def ctx():
+    with app.app_context():
+        EmailPendente.query.delete()
+        db.session.commit()
+        yield
+        db.session.rollback()
+
+
+@pytest.fixture
+def smtp():
+    caixa = _Caixa()
+    controller = Controller(caixa, hostname='127.0.0.1', port=int(os.environ['MAIL_PORT']))
+    controller.start()
+    yield caixa
+    controller.stop()
+
+
+def test_entrega_e_remove_da_fila(ctx, smtp):
+    assert main.enfileirar_email('rh@teste.local', 'Nova denúncia recebida', 'Protocolo: ABC123')
+    assert main.enfileirar_email('rh2@teste.local', 'Nova denúncia recebida', 'Protocolo: ABC123')
+    db.session.commit()
+
+    assert main.processar_fila_email() == 2
+
+    assert sorted(r for (r,), _ in smtp.recebidos) == ['rh2@teste.local', 'rh@teste.local']
+    assert 'Protocolo: ABC123' in smtp.recebidos[0][1]
+    assert EmailPendente.query.count() == 0
+
+
+def test_aviso_com_chave_nao_duplica(ctx, smtp):
+    assert main.enfileirar_email('rh@teste.local', 'Nova mensagem', 'x', chave='chat:ABC123')
+    db.session.commit()
+    assert not main.enfileirar_email('rh@teste.local', 'Nova mensagem', 'x', chave='chat:ABC123')
+
+    assert main.processar_fila_email() == 1
+    assert len(smtp.recebidos) == 1
+
+
+def test_falha_de_conexao_reagenda_com_backoff(ctx):
+    # Sem servidor na porta: a conexão falha e o e-mail volta para a fila
+    main.enfileirar_email('rh@teste.local', 'Nova denúncia recebida', 'corpo')
+    db.session.commit()
+
+    assert main.processar_fila_email() == 1
+
+    e = EmailPendente.query.one()
+    assert e.status == 'pendente'
+    assert e.tentativas == 1
+    assert e.erro
+    assert e.proxima_tentativa > main._agora()
+    # Ainda dentro do backoff: nada é reservado
+    assert main.processar_fila_email() == 0
+
+
+def test_desiste_apos_max_tentativas(ctx, monkeypatch):
+    monkeypatch.setattr(main, 'MAIL_MAX_TENTATIVAS', 1)
+    main.enfileirar_email('rh@teste.local', 'Nova denúncia recebida', 'corpo')
+    db.session.commit()
+
+    main.processar_fila_email()
+
+    assert EmailPendente.query.one().status == 'falhou'
+
+
+def test_avisos_agrupados_nao_sao_descartados_com_fila_cheia(ctx, smtp, monkeypatch):
+    monkeypatch.setattr(main, 'MAIL_FILA_MAX', 1)
+    assert main.enfileirar_email('rh@teste.local', 'Nova denúncia recebida', 'Protocolo: A1',
+                                 chave='denuncias', agrupar=True)
+    db.session.commit()
+    # Fila cheia: o aviso comum é descartado, o agrupado entra no pendente
+    assert not main.enfileirar_email('outro@teste.local', 'Assunto', 'corpo')
+    assert main.enfileirar_email('rh@teste.local', 'Nova denúncia recebida', 'Protocolo: B2',
+                                 chave='denuncias', agrupar=True)
+    db.session.commit()
+    assert EmailPendente.query.count() == 1
+
+    assert main.processar_fila_email() == 1
+    (destinatarios, conteudo), = smtp.recebidos
+    assert 'Protocolo: A1' in conteudo and 'Protocolo: B2' in conteudo
+
+
+def test_aviso_em_envio_nao_recebe_agrupamento(ctx):
+    main.enfileirar_email('rh@teste.local', 'Nova denúncia recebida', 'Protocolo: A1',
+                          chave='denuncias', agrupar=True)
+    db.session.commit()
+    assert [e.status for e in main._reservar_lote(10)] == ['enviando']
+
+    main.enfileirar_email('rh@teste.local', 'Nova denúncia recebida', 'Protocolo: B2',
+                          chave='denuncias', agrupar=True)
+    db.session.commit()
+
+    novo = EmailPendente.query.filter_by(status='pendente').one()
+    assert novo.corpo == 'Protocolo: B2'
+
+
+def test_falhas_antigas_sao_apagadas(ctx):
+    agora = main._agora()
+    db.session.add_all([
+        EmailPendente(destinatario='a@teste.local', assunto='x', corpo='x', status='falhou',
+                      proxima_tentativa=agora - main.timedelta(days=main.MAIL_FALHAS_DIAS + 1)),
+        EmailPendente(destinatario='b@teste.local', assunto='x', corpo='x', status='falhou',
+                      proxima_tentativa=agora),
+    ])
+    db.session.commit()
+
+    main.limpar_falhas_email()
+
+    assert [e.destinatario for e in EmailPendente.query] == ['b@teste.local']